@@ -0,0 +1,51 @@
+'''
+alias_sampler.py - benchmark of gacha roll drawing
+
+Compares the cached AliasSampler with random.choices over the pool weights,
+at 1, 10 and 300 rolls per command.
+
+    python -m benchmarks.alias_sampler [gacha id]
+
+Uses the rates of the given gacha's pool, or a synthetic pool of CARDS cards without one.
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import random
+import sys
+import timeit
+
+from deresute import roller
+
+
+CARDS = 260
+ROLLS = (1, 10, 300)
+NUMBER = 2000
+
+
+def _get_weights(id=None):
+    '''
+    Get the normal roll rates of the pool, or synthetic ones.
+    :type id: int or None
+    :rtype: list
+    '''
+    if id is not None:
+        return list(roller.get_pool(id).rate)
+    rng = random.Random(15)
+    return [rng.choice((0.0003, 0.003, 0.0035, 0.004)) for _ in range(CARDS)]
+
+
+if __name__ == '__main__':
+    weights = _get_weights(int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    population = list(range(len(weights)))
+    sampler = roller.AliasSampler(weights)
+
+    build = min(timeit.repeat(lambda: roller.AliasSampler(weights), number=100, repeat=5)) / 100
+    print('{0} cards, alias table built once in {1:.1f} us'.format(len(weights), build * 1e6))
+    for k in ROLLS:
+        choices = min(timeit.repeat(lambda: random.choices(population, weights, k=k), number=NUMBER, repeat=5))
+        alias = min(timeit.repeat(lambda: sampler.sample(k), number=NUMBER, repeat=5))
+        print('{0:>4} rolls: random.choices {1:8.1f} us   alias {2:8.1f} us   x{3:.1f}'.format(
+            k, choices / NUMBER * 1e6, alias / NUMBER * 1e6, choices / alias))
@@ -0,0 +1,103 @@
+'''
+border_parse.py - benchmark of the aidoru border page parser
+
+Compares the streaming datum extractor with the old BeautifulSoup parse on the saved
+border page, inflated to a full event (POINTS collections per tier).
+Reports the time per parse and the peak traced memory, and the same for the extraction alone.
+
+    python -m benchmarks.border_parse
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+from bs4 import BeautifulSoup
+import json
+import os
+import re
+import timeit
+import tracemalloc
+
+from deresute import event
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), '..', 'tests', 'fixtures', 'aidoru_border.html')
+
+# 10 days of collections every 15 minutes
+POINTS = 10 * 24 * 4
+REPEAT = 20
+
+
+def _inflate(page):
+    '''
+    Repeat the values of every tier until it has POINTS collections.
+    :type page: str
+    :rtype: str
+    '''
+    def values(m):
+        points = json.loads(m.group(1))
+        step = points[1][0] - points[0][0]
+        start, value = points[-1]
+        points += [[start + step * i, value + 1000 * i] for i in range(1, POINTS - len(points) + 1)]
+        return 'values: ' + json.dumps(points)
+    return re.sub(r'values: (\[\[.*?\]\])', values, page)
+
+
+def _soup(page):
+    '''
+    The old parse: build the whole DOM, then split the chart script.
+    :type page: str
+    :rtype: list
+    '''
+    soup = BeautifulSoup(page, 'html.parser')
+    text = soup.findAll('script', {"type": "text/javascript"})[3].text
+    text = text.split('d3.select(\'#chart_div\').append(\'svg\')\n\t\t\t\t.datum(function() {\n\t\t\t\t\treturn ')[1]
+    text = text.split('\n\t\t\t\t})\n\t\t\t\t.call(chart);')[0]
+    return event._parse_datum(text)
+
+
+def _stream(page):
+    '''
+    The streaming parse, fed in CHUNK_SIZE chunks as resp.iter_content does.
+    :type page: str
+    :rtype: list
+    '''
+    chunks = (page[i:i + event.CHUNK_SIZE] for i in range(0, len(page), event.CHUNK_SIZE))
+    return event._parse_datum(event._extract_datum(chunks))
+
+
+def _extract(page):
+    '''
+    The streaming extraction alone, without the json parse.
+    :type page: str
+    :rtype: str
+    '''
+    chunks = (page[i:i + event.CHUNK_SIZE] for i in range(0, len(page), event.CHUNK_SIZE))
+    return event._extract_datum(chunks)
+
+
+def _measure(func, page):
+    '''
+    Get the seconds per call and the peak traced bytes of one call.
+    :type func: function
+    :type page: str
+    :rtype: (float, int)
+    '''
+    seconds = min(timeit.repeat(lambda: func(page), number=1, repeat=REPEAT))
+    tracemalloc.start()
+    func(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+if __name__ == '__main__':
+    with open(FIXTURE, 'r', encoding='utf-8') as f:
+        page = _inflate(f.read())
+    assert _soup(page) == _stream(page)
+
+    print('page: {0:,} bytes, {1} points per tier'.format(len(page.encode('utf-8')), POINTS))
+    for name, func in (('beautifulsoup', _soup), ('stream', _stream), ('extract only', _extract)):
+        seconds, peak = _measure(func, page)
+        print('{0:>14}: {1:8.2f} ms  peak {2:8.1f} KiB'.format(name, seconds * 1000, peak / 1024))
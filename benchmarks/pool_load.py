@@ -0,0 +1,116 @@
+'''
+pool_load.py - benchmark of gacha pool loading
+
+Compares reading every pool as json with mapping it as a pool file: the load time,
+the memory held by the loaded pools (tracemalloc), and the process max RSS after each.
+
+    python -m benchmarks.pool_load [pool directory]
+
+Uses the json pools of the directory (roller.DIR by default), converting them into a temporary
+directory, or POOLS synthetic pools of CARDS cards without any.
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from deresute import poolfile, roller
+
+
+POOLS = 400
+CARDS = 260
+
+
+def _get_pools(dir):
+    '''
+    Get the valid json pools of the directory.
+    :type dir: str
+    :rtype: list of str
+    '''
+    filepaths = []
+    for filename in sorted(os.listdir(dir)) if os.path.isdir(dir) else []:
+        filepath = os.path.join(dir, filename)
+        if filename.endswith('.json'):
+            try:
+                poolfile.read_json(filepath)
+            except poolfile.PoolFileError:
+                continue
+            filepaths.append(filepath)
+    return filepaths
+
+
+def _write_synthetic(dir):
+    '''
+    Write POOLS synthetic json pools into the directory.
+    :type dir: str
+    :rtype: list of str
+    '''
+    rng = random.Random(22)
+    names = ['idol{0}'.format(i) for i in range(190)]
+    filepaths = []
+    for id in range(POOLS):
+        cards = [{'name': rng.choice(names), 'tag': '[tag{0}]'.format(rng.randrange(1000)),
+                  'rarity': rng.choice(poolfile.RARITIES), 'lim': rng.random() < 0.05,
+                  'rate': rng.choice((0.0003, 0.003, 0.0035, 0.004)), 'sp_rate': 0.0} for _ in range(CARDS)]
+        filepath = os.path.join(dir, '{0}.json'.format(id))
+        with open(filepath, 'w') as f:
+            json.dump(cards, f)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def _measure(load, filepaths):
+    '''
+    Load every pool and keep them, measuring the time, the memory held and the max RSS.
+    :type load: function
+    :type filepaths: list of str
+    :rtype: (float, int, int), seconds, bytes, kilobytes
+    '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    pools = [load(filepath) for filepath in filepaths]
+    elapsed = time.perf_counter() - start
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del pools
+    return elapsed, held, rss
+
+
+def _load_json(filepath):
+    '''
+    Read the json pool the way the bot did before pool files.
+    :type filepath: str
+    :rtype: list
+    '''
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    tmp = tempfile.mkdtemp()
+    try:
+        sources = _get_pools(sys.argv[1] if len(sys.argv) > 1 else roller.DIR) or _write_synthetic(tmp)
+        converted = [poolfile.convert(src, os.path.join(tmp, os.path.basename(src)[:-5] + poolfile.EXT))
+                     for src in sources]
+        print('{0} pools, {1:,} json bytes, {2:,} pool file bytes'.format(
+            len(sources), sum(map(os.path.getsize, sources)), sum(map(os.path.getsize, converted))))
+
+        # Pool files first, as the max RSS only grows
+        for label, load, filepaths in (('pool file', poolfile.load, converted), ('json', _load_json, sources)):
+            elapsed, held, rss = _measure(load, filepaths)
+            print('{0:>9}: {1:8.1f} ms   held {2:10,} bytes   max rss {3:,} KB'.format(label, elapsed * 1e3, held, rss))
+    finally:
+        shutil.rmtree(tmp)
@@ -20,7 +20,9 @@ import logging
 import pytz
 import os
 import re
+import telegram.error
 import telegram.ext as tg
+import threading
 
 import deresute
 
@@ -32,6 +34,17 @@ Definitions
 CFG_FILE = '.config'
 JST = pytz.timezone('Asia/Tokyo')
 
+# Seconds between cutoff prefetch checks while there is no ranking event
+PREFETCH_IDLE = 60 * 60
+
+# Chats that get the gacha changeover announcement
+SUBSCRIBERS = os.path.join(os.getcwd(), 'data', 'deresute', 'subscribers.json')
+_subscribers_lock = threading.Lock()
+
+# Minutes before a gacha changeover to prepare and to send the announcement
+PREPARE_LEAD = 30
+ANNOUNCE_LEAD = 5
+
 
 '''
 Config Related Private Helper Functions
@@ -90,6 +103,32 @@ def _has_tag(text):
     return any(tag in text for tag in tags)
 
 
+def _get_subscribers():
+    '''
+    Get the chat_ids subscribed to announcements.
+    :rtype: list
+    '''
+    if not os.path.isfile(SUBSCRIBERS):
+        return []
+    with open(SUBSCRIBERS, 'r') as f:
+        return json.load(f)
+
+
+def _update_subscribers(chat_id, subscribed):
+    '''
+    Add the chat_id to, or remove it from, the chats subscribed to announcements.
+    :type chat_id: int
+    :type subscribed: bool
+    '''
+    with _subscribers_lock:
+        chat_ids = set(_get_subscribers())
+        if subscribed:
+            chat_ids.add(chat_id)
+        else:
+            chat_ids.discard(chat_id)
+        deresute.storage.write_json(SUBSCRIBERS, sorted(chat_ids), indent=2)
+
+
 '''
 Private Helper Functions
 '''
@@ -106,6 +145,15 @@ def _get_patterns(json):
     return patterns
 
 
+def _get_delay(timestamp):
+    '''
+    Get seconds from now until timestamp.
+    :type timestamp: int
+    :rtype: float
+    '''
+    return (datetime.fromtimestamp(timestamp) - datetime.now()).total_seconds()
+
+
 def _get_tmr():
     '''
     Get datetime object of next 12am (JST).
@@ -132,8 +180,11 @@ def _event_helper(type, unit, rank=None):
         return canned['No_Event']
 
     # Parse event information into output
+    stale = resp.get('stale')
     resp = resp['events'][0]
     result, ended = deresute.event.event_output(resp)
+    if stale:
+        result += canned['Stale'].format(int(stale // 60))
 
     # Get cutoff data
     try:
@@ -146,6 +197,34 @@ def _event_helper(type, unit, rank=None):
     return result
 
 
+def _projection_helper(type, unit):
+    '''
+    Helper function for border projection commands.
+    :type type: str
+    :type unit: str
+    :rtype: str
+    '''
+    # Check what is happening
+    resp = deresute.happening.now()
+    if not resp or not resp['events']:
+        return canned['No_Event']
+
+    # Parse event information into output
+    resp = resp['events'][0]
+    result, ended = deresute.event.event_output(resp)
+
+    # Make sure the border history is up to date, then project it
+    try:
+        deresute.event.get_cutoffs(resp['id'], type)
+        projection = deresute.event.get_projection(resp['id'], resp['end_date'], type)
+        result += '\n' + deresute.event.projection_output(projection, unit)
+    except (deresute.event.CurrentEventNotValidError, deresute.event.CurrentEventNotRankingError) as e:
+        return result + canned['Not_Ranking']
+    except (deresute.event.NoDataCurrentlyAvailableError, TypeError) as e:
+        return result + canned['No_Data']
+    return result
+
+
 def _gacha_roll_helper(total, index):
     '''
     Gacha roll helper function.
@@ -167,6 +246,47 @@ def _gacha_roll_helper(total, index):
     return deresute.roller.output(gacha, total)
 
 
+def _get_gacha(index):
+    '''
+    Get the dict info for the current gacha at index (1-based, first gacha if out of range).
+    :type index: int
+    :rtype: dict or None
+    '''
+    resp = deresute.happening.now()
+    if not resp or not resp['gachas']:
+        return None
+
+    # Try to get the dict info for gacha
+    resp = resp['gachas']
+    try:
+        return resp[index - 1]
+    except IndexError:
+        return resp[0]
+
+
+def _gacha_sim_helper(pulls, index, query):
+    '''
+    Gacha simulation helper function.
+    :type pulls: int
+    :type index: int
+    :type query: str or None
+    :rtype: str or None
+    '''
+    gacha = _get_gacha(index)
+    return deresute.simulator.output(gacha, pulls, query) if gacha else None
+
+
+def _gacha_odds_helper(total, index):
+    '''
+    Gacha odds helper function.
+    :type total: int
+    :type index: int
+    :rtype: str or None
+    '''
+    gacha = _get_gacha(index)
+    return deresute.odds.output(gacha, total) if gacha else None
+
+
 def _error(bot, update, error):
     '''Log Errors caused by Updates.'''
     logger.warning('Update "{0}" caused error "{1}"'.format(update, error))
@@ -182,6 +302,12 @@ def event(bot, update):
     update.message.reply_text(_event_helper('EVENT', 'pts'))
 
 
+def projection(bot, update):
+    '''Send messages when command /projection is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    update.message.reply_text(_projection_helper('EVENT', 'pts'))
+
+
 def trophy(bot, update):
     '''Send messages when command /trophy is issued.'''
     logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
@@ -209,8 +335,17 @@ def gacha(bot, update):
 
     # Get gacha outputs
     gachas = {}
-    gachas['curr'] = deresute.gacha.get_curr(resp['gachas'])
-    gachas['next'] = deresute.gacha.get_next(resp['gachas'])
+    try:
+        gachas['curr'] = deresute.gacha.get_curr(resp['gachas'])
+        gachas['next'] = deresute.gacha.get_next(resp['gachas'])
+    except deresute.gacha.HistoryNotAvailableError as e:
+        logger.warning('gacha lookup failed: {0}'.format(e))
+        update.message.reply_text(canned['No_Data'])
+        return
+
+    # Mark data served while upstream is down
+    if resp.get('stale'):
+        gachas['curr'][-1] += canned['Stale'].format(int(resp['stale'] // 60))
 
     # Output messages
     for gacha in gachas['curr']:
@@ -230,7 +365,12 @@ def next_gacha(bot, update):
         update.message.reply_text(canned['No_Data'])
 
     # Get gacha outputs
-    gachas = deresute.gacha.get_next(resp['gachas'])
+    try:
+        gachas = deresute.gacha.get_next(resp['gachas'])
+    except deresute.gacha.HistoryNotAvailableError as e:
+        logger.warning('gacha lookup failed: {0}'.format(e))
+        update.message.reply_text(canned['No_Data'])
+        return
 
     # Output messages
     if gachas:
@@ -260,12 +400,92 @@ def roll(bot, update):
 
     # Send stickers for single roll
     if count == 1:
-        if not output['card']['lim'] and output['card']['rarity'] != 'SSR':
+        if not output['card'].lim and output['card'].rarity != 'SSR':
             update.message.reply_sticker(canned['Chihiro_R'])
         else:
             update.message.reply_sticker(canned['Chihiro_SSR'])
 
 
+def subscribe(bot, update):
+    '''Subscribe the chat to gacha changeover announcements when command /subscribe is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    _update_subscribers(update.message.chat.id, True)
+    update.message.reply_text(canned['Subscribed'])
+
+
+def unsubscribe(bot, update):
+    '''Unsubscribe the chat from gacha changeover announcements when command /unsubscribe is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    _update_subscribers(update.message.chat.id, False)
+    update.message.reply_text(canned['Unsubscribed'])
+
+
+@tg.run_async
+def sim(bot, update):
+    '''Send messages when command /(number)sim is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+
+    # Get parameters from input message
+    params = patterns['sim'].match(update.message.text).groups()
+    pulls = int(params[0]) if params[0] and 0 < int(params[0]) <= 3000 else 300
+    index = int(params[1]) if params[1] else 0
+    query = params[2].strip() if params[2] else None
+
+    # Simulations run on the process pool, away from the dispatcher
+    output = _gacha_sim_helper(pulls, index, query)
+    update.message.reply_text(output if output else canned['No_Data'])
+
+
+def card(bot, update, args):
+    '''Send the gachas that had the cards of an idol when command /card (name) is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    if not args:
+        update.message.reply_text(canned['No_Card'])
+        return
+
+    resp = deresute.happening.now()
+    current = [gacha['id'] for gacha in resp['gachas']] if resp else []
+    output = deresute.roller.find_output(' '.join(args), current)
+    update.message.reply_text(output if output else canned['No_Card'])
+
+
+def idol(bot, update, args):
+    '''Send the idols matching a name when command /idol (name) is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    output = deresute.idols.output(' '.join(args)) if args else None
+    update.message.reply_text(output if output else canned['No_Idol'])
+
+
+def birthday(bot, update, args):
+    '''Send the upcoming birthdays when command /birthday, /birthday (days), /birthday month or /birthday (name) is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    if not args:
+        birthdays = deresute.birthday.get_range()
+    elif args[0].isdigit():
+        birthdays = deresute.birthday.get_range(min(int(args[0]), 366))
+    elif args[0] in ('month', '月', '今月'):
+        birthdays = deresute.birthday.get_month()
+    else:
+        birthdays = deresute.birthday.find(' '.join(args))
+
+    output = deresute.birthday.output(birthdays)
+    update.message.reply_text(output if output else canned['No_Birthday'])
+
+
+def odds(bot, update):
+    '''Send messages when command /(number)odds or /odds (number) is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+
+    # Get parameters from input message
+    params = patterns['odds'].match(update.message.text).groups()
+    total = params[0] or params[2]
+    total = int(total) if total and 0 < int(total) <= 3000 else 300
+    index = int(params[1]) if params[1] else 0
+
+    output = _gacha_odds_helper(total, index)
+    update.message.reply_text(output if output else canned['No_Data'])
+
+
 '''
 Command Functions - Others
 '''
@@ -275,11 +495,18 @@ def help(bot, update):
     logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
     output = output = 'CGSS相關指令列表:' + \
              '\n/event - イベント資訊' + \
+             '\n/projection - 最終ボーダー予想' + \
              '\n/trophy - 飛機盃資訊' + \
              '\n/gacha - ガチャ資訊' + \
+             '\n/subscribe - ガチャ更新通知' + \
              '\n/roll - 單抽' + \
              '\n/10roll - 十連' + \
-             '\n/300roll - 300連/井'
+             '\n/300roll - 300連/井' + \
+             '\n/300sim - 限定SSR確率シミュレーション' + \
+             '\n/odds 300 - SSR確率' + \
+             '\n/card 鷺沢文香 - カードのガチャ履歴' + \
+             '\n/idol ふみか - アイドル検索' + \
+             '\n/birthday - 誕生日 (7日 / month / 名前)'
     update.message.reply_text(output)
 
 
@@ -327,10 +554,76 @@ def callback_birthday(bot, job):
         bot.send_message(chat_id=_get_chat_id(chat='Chihiro'), text=congrats)
 
 
+def callback_cutoffs(bot, job):
+    '''Job to warm the cutoff cache shortly after each border collection.'''
+    delay = PREFETCH_IDLE
+    resp = deresute.happening.now()
+    if resp and resp['events']:
+        try:
+            delay = deresute.event.prefetch(resp['events'][0]['id'], 'EVENT')
+        except (deresute.event.CurrentEventNotValidError, deresute.event.CurrentEventNotRankingError) as e:
+            pass
+        except Exception as e:
+            logger.warning('cutoff prefetch failed: {0}'.format(e))
+            delay = deresute.event.COLLECT_RETRY
+
+    # Schedule the next run at the next expected collection
+    logger.info('cutoff prefetch in {0:.0f} seconds'.format(delay))
+    job.job_queue.run_once(callback_cutoffs, delay)
+
+
+def callback_gacha_schedule(bot, job):
+    '''Job to schedule the announcement of the next gacha changeover.'''
+    resp = deresute.happening.now()
+    if not resp or not resp['gachas']:
+        job.job_queue.run_once(callback_gacha_schedule, PREFETCH_IDLE)
+        return
+
+    # Prepare the message well before the changeover, and look again right after it
+    delay = _get_delay(resp['gachas'][0]['end_date'])
+    if delay > ANNOUNCE_LEAD * 60:
+        job.job_queue.run_once(callback_gacha_prepare, max(delay - PREPARE_LEAD * 60, 0), context=resp['gachas'])
+    job.job_queue.run_once(callback_gacha_schedule, max(delay, 0) + 60)
+
+
+def callback_gacha_prepare(bot, job):
+    '''Job to precompute the next gacha message.'''
+    gachas = job.context
+    messages = deresute.gacha.preview_next(gachas, ANNOUNCE_LEAD)
+    delay = _get_delay(gachas[0]['end_date']) - ANNOUNCE_LEAD * 60
+    job.job_queue.run_once(callback_gacha_announce, max(delay, 0), context=messages)
+
+
+def callback_gacha_announce(bot, job):
+    '''Job to send the next gacha message to the subscribed chats.'''
+    logger.info('gacha changeover announcement')
+    for chat_id in _get_subscribers():
+        # A chat that fails must not stop the announcement to the others
+        try:
+            for message in job.context:
+                bot.send_message(chat_id=chat_id, text=message)
+            bot.send_animation(chat_id=chat_id, animation=canned['Chihiro_Money'])
+        except telegram.error.Unauthorized as e:
+            # The bot was blocked or removed from the chat
+            logger.warning('announcement to {0} unauthorized, unsubscribing: {1}'.format(chat_id, e))
+            _update_subscribers(chat_id, False)
+        except telegram.error.TelegramError as e:
+            logger.warning('announcement to {0} failed: {1}'.format(chat_id, e))
+
+
 '''
 Debug
 '''
 
+def stats(bot, update):
+    '''Send cache statistics to the owner when command /stats is issued.'''
+    logger.info('{0} @ {1}: {2}'.format(update.message.from_user.username, update.message.chat.title, update.message.text))
+    output = 'happening: {0}'.format(deresute.happening.stats()) + \
+             '\nnetwork: {0}'.format(deresute.network.stats()) + \
+             '\npools: {0}'.format(deresute.roller.stats())
+    update.message.reply_text(output)
+
+
 def debug(bot, update):
     '''Echo the user message.'''
     logger.info('{0} @ {1}'.format(update.message.from_user.username, update.message.chat.id))
@@ -351,18 +644,34 @@ def main():
     dp = updater.dispatcher
     jq = updater.job_queue
 
+    # Build the idol name index before the first query
+    deresute.idols.load()
+
+    # Gather the pools of new gachas as soon as they show up
+    deresute.happening.listen(deresute.roller.prefetch_pools)
+
     # JobQueue functions
     job_bday = jq.run_repeating(callback_birthday, interval=timedelta(days=1), first=_get_tmr())
+    job_cutoffs = jq.run_once(callback_cutoffs, 0)
+    job_gacha = jq.run_once(callback_gacha_schedule, 0)
 
     # Event related
     dp.add_handler(tg.CommandHandler('event', event))
+    dp.add_handler(tg.CommandHandler('projection', projection))
     # dp.add_handler(tg.CommandHandler('trophy', trophy))
     # dp.add_handler(tg.RegexHandler(patterns['top'], top))
 
     # Gacha related
     dp.add_handler(tg.CommandHandler('gacha', gacha))
     # dp.add_handler(tg.CommandHandler('nextgacha', next_gacha))
+    dp.add_handler(tg.CommandHandler('subscribe', subscribe))
+    dp.add_handler(tg.CommandHandler('unsubscribe', unsubscribe))
     # dp.add_handler(tg.RegexHandler(patterns['roll'], roll))
+    dp.add_handler(tg.RegexHandler(patterns['sim'], sim))
+    dp.add_handler(tg.RegexHandler(patterns['odds'], odds))
+    dp.add_handler(tg.CommandHandler('card', card, pass_args=True))
+    dp.add_handler(tg.CommandHandler('idol', idol, pass_args=True))
+    dp.add_handler(tg.CommandHandler('birthday', birthday, pass_args=True))
 
     # Others
     dp.add_handler(tg.RegexHandler(patterns['help'], help))
@@ -374,6 +683,7 @@ def main():
     dp.add_handler(tg.MessageHandler(tg.Filters.chat(chat_id=_get_forward('Chihiro')), forward))
 
     # Debug
+    dp.add_handler(tg.CommandHandler('stats', stats, filters=tg.Filters.user(username=_get_username())))
     dp.add_handler(tg.MessageHandler(tg.Filters.user(username=_get_username()), debug))
 
     # log errors
@@ -2,15 +2,26 @@
 from .happening import now, at
 
 # event.py
-from .event import get_cutoffs, event_output, cutoff_output
+from .event import get_cutoffs, get_series, get_projection, prefetch
+from .event import event_output, cutoff_output, projection_output
 from .event import NoDataCurrentlyAvailableError, NoCurrentEventError
 from .event import CurrentEventNotValidError, CurrentEventNotRankingError
 
 # gacha.py
-from .gacha import get_curr, get_next
+from .gacha import get_curr, get_next, preview_next
 
 # roller.py
-from .roller import output
+from .roller import output, get_pool, get_card, prefetch_pools
+from .roller import find_card, find_output
+
+# simulator.py
+from .simulator import simulate
+
+# odds.py
+from .odds import get_odds
+
+# idols.py
+from .idols import search, translate
 
 # birthday.py
-from .birthday import get_date, get_today
+from .birthday import get_date, get_today, get_range, get_month
@@ -6,14 +6,20 @@ Github: https://github.com/maplemist
 Telegram: @maplemist
 '''
 
+from bisect import bisect_left
 from bs4 import BeautifulSoup
-from datetime import datetime
+from calendar import isleap
+from datetime import date, datetime, timedelta
 import collections
 import json
 import os
 import pytz
 import regex
-import requests
+import threading
+
+from . import idols
+from . import network
+from . import storage
 
 
 '''
@@ -25,6 +31,18 @@ FILENAME = 'birthdays.json'
 URL = 'https://imas-db.jp/calendar/birthdays'
 JST = pytz.timezone('Asia/Tokyo')
 
+# Days of the year are counted in a leap year, so 2/29 has its own day
+LEAP_YEAR = 2000
+
+# Days looked ahead by default
+DAYS = 7
+
+birthday_t = collections.namedtuple('birthday_t', ('month', 'day', 'name', 'kind'))
+
+# Birthdays per day of the year, the days with any in order, the birthdays per name, and the mtime they were read at
+_calendar = {'days': {}, 'order': [], 'names': {}, 'mtime': None}
+_lock = threading.Lock()
+
 
 '''
 Private Function
@@ -37,14 +55,8 @@ def _write_file(data, dir, filename):
     :type dir: str
     :type filename: str
     '''
-    # Check directory
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-
     # Write birthday data to json file
-    filepath = os.path.join(dir, filename)
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False, sort_keys=True)
+    storage.write_json(os.path.join(dir, filename), data, indent=2, ensure_ascii=False, sort_keys=True)
 
 
 def _get_from_db():
@@ -55,7 +67,7 @@ def _get_from_db():
     data = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(list)))
 
     # Read from online database
-    resp = requests.get(URL)
+    resp = network.get(URL)
     soup = BeautifulSoup(resp.text, 'html.parser')
     months = soup.findAll('ul', {'class': 'birthdays-list'})
     for month in months:
@@ -91,6 +103,71 @@ def _get_all():
     return data
 
 
+def _get_day(month, day):
+    '''
+    Get the day of the year of the date, counted in a leap year.
+    :type month: int
+    :type day: int
+    :rtype: int
+    '''
+    return date(LEAP_YEAR, month, day).timetuple().tm_yday
+
+
+def _get_calendar():
+    '''
+    Get the birthday calendar, reading the file again only when it changed.
+    :rtype: dict
+    '''
+    filepath = os.path.join(DIR, FILENAME)
+    with _lock:
+        try:
+            mtime = os.path.getmtime(filepath)
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime == _calendar['mtime']:
+            return _calendar
+
+        data = _get_all()
+        days, names = collections.defaultdict(list), collections.defaultdict(list)
+        for kind in ('CHAR', 'CV'):
+            for month, dds in data[kind].items():
+                for dd, entities in dds.items():
+                    for name in entities:
+                        birthday = birthday_t(int(month), int(dd), name, kind)
+                        days[_get_day(birthday.month, birthday.day)].append(birthday)
+                        names[name].append(birthday)
+
+        _calendar.update(days=dict(days), order=sorted(days), names=dict(names))
+        _calendar['mtime'] = os.path.getmtime(filepath) if os.path.isfile(filepath) else None
+        return _calendar
+
+
+def _get_between(calendar, first, last):
+    '''
+    Get the birthdays from day first to day last of the year.
+    :type calendar: dict
+    :type first: int
+    :type last: int
+    :rtype: list of birthday_t
+    '''
+    order = calendar['order']
+    results = []
+    for i in range(bisect_left(order, first), len(order)):
+        if order[i] > last:
+            break
+        results += calendar['days'][order[i]]
+    return results
+
+
+def _get_date(dt):
+    '''
+    Get the date in Japan.
+    :type dt: datetime or None
+    :rtype: datetime
+    '''
+    return dt or pytz.utc.localize(datetime.utcnow()).astimezone(JST)
+
+
 '''
 Public Functions
 '''
@@ -101,9 +178,11 @@ def get_date(datetime):
     :type datetime: datetime
     :rtype: list
     '''
-    data = _get_all()
-    return data['CHAR'][str(datetime.month)].get(str(datetime.day), []) + \
-           data['CV'][str(datetime.month)].get(str(datetime.day), [])
+    # 2/29 only counts in leap years
+    if datetime.month == 2 and datetime.day == 29 and not isleap(datetime.year):
+        return []
+    birthdays = _get_calendar()['days'].get(_get_day(datetime.month, datetime.day), [])
+    return [birthday.name for birthday in birthdays]
 
 
 def get_today():
@@ -112,3 +191,61 @@ def get_today():
     :rtype: list
     '''
     return get_date(pytz.utc.localize(datetime.utcnow()).astimezone(JST))
+
+
+def get_range(days=DAYS, start=None):
+    '''
+    Get the birthdays in the days from start on, in date order.
+    :type days: int
+    :type start: datetime or None, today in Japan if None
+    :rtype: list of birthday_t
+    '''
+    start = _get_date(start)
+    end = start + timedelta(days=max(days, 1) - 1)
+    calendar = _get_calendar()
+    first, last = _get_day(start.month, start.day), _get_day(end.month, end.day)
+
+    # A year or more is the whole calendar once, from start on
+    if days >= 365:
+        return _get_between(calendar, first, 366) + _get_between(calendar, 1, first - 1)
+
+    # Wrap around the end of the year
+    if end.year > start.year:
+        return _get_between(calendar, first, 366) + _get_between(calendar, 1, last)
+    return _get_between(calendar, first, last)
+
+
+def get_month(start=None):
+    '''
+    Get the birthdays of the month, in date order.
+    :type start: datetime or None, this month in Japan if None
+    :rtype: list of birthday_t
+    '''
+    start = _get_date(start)
+    first = _get_day(start.month, 1)
+    return [birthday for birthday in _get_between(_get_calendar(), first, first + 30) if birthday.month == start.month]
+
+
+def find(query):
+    '''
+    Get the birthdays of the idols or voice actors matching the name.
+    :type query: str
+    :rtype: list of birthday_t
+    '''
+    names = _get_calendar()['names']
+    return [birthday for idol in idols.search(query) for birthday in names.get(idol.name, [])]
+
+
+def output(birthdays):
+    '''
+    Get the message listing the birthdays, one date per line.
+    :type birthdays: list of birthday_t
+    :rtype: str or None
+    '''
+    if not birthdays:
+        return None
+    lines = collections.OrderedDict()
+    for birthday in birthdays:
+        name = birthday.name + (' (CV)' if birthday.kind == 'CV' else '')
+        lines.setdefault((birthday.month, birthday.day), []).append(name)
+    return '\n'.join('{0}/{1} {2}'.format(month, day, ', '.join(names)) for (month, day), names in lines.items())
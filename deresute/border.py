@@ -0,0 +1,168 @@
+'''
+border.py - .py file to keep the border history of an event.
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+from array import array
+from bisect import bisect_left, bisect_right
+import collections
+import math
+
+
+'''
+Definitions
+'''
+
+# For some reason the timestamp is not unix epoch time and it is 9 hours ahead of it
+OFFSET = 60 * 60 * 9
+
+# Projections fit the last FIT_WINDOW seconds of every tier, and need at least FIT_MIN points
+FIT_WINDOW = 24 * 60 * 60
+FIT_MIN = 4
+
+# z-score of the confidence band (95%)
+Z = 1.96
+
+projection_t = collections.namedtuple('projection_t', ('position', 'points', 'low', 'high'))
+
+
+class BorderSeries(object):
+    '''
+    Border history of an event.
+    One shared array of timestamps, and one float array of points per tier (nan where a tier has no point).
+    '''
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.timestamps = array('d')
+        self.tiers = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def extend(self, border_data):
+        '''
+        Append the points newer than the last stored timestamp.
+        :type border_data: list
+        :rtype: int
+        '''
+        last = self.timestamps[-1] if self.timestamps else -math.inf
+        points = collections.defaultdict(dict)
+        for data in border_data:
+            tier = data['key'].split(' ')[0]
+            if tier not in self.tiers:
+                self.tiers[tier] = array('d', [math.nan]) * len(self.timestamps)
+
+            # Values are in time order, so stop at the first point already stored
+            for timestamp, value in reversed(data['values']):
+                timestamp = to_unix(timestamp)
+                if timestamp <= last:
+                    break
+                points[timestamp][tier] = value
+
+        for timestamp in sorted(points):
+            self.timestamps.append(timestamp)
+            for tier, values in self.tiers.items():
+                values.append(points[timestamp].get(tier, math.nan))
+        return len(points)
+
+    def value(self, tier, index=-1):
+        '''
+        Get the points of the tier at index.
+        :type tier: str
+        :type index: int
+        :rtype: float
+        '''
+        return self.tiers[tier][index]
+
+    def at(self, tier, timestamp):
+        '''
+        Get the latest points of the tier at or before timestamp.
+        :type tier: str
+        :type timestamp: float
+        :rtype: float or None
+        '''
+        index = bisect_right(self.timestamps, timestamp)
+        values = self.tiers[tier]
+        while index > 0:
+            index -= 1
+            if not math.isnan(values[index]):
+                return values[index]
+        return None
+
+    def delta(self, tier, seconds):
+        '''
+        Get how much the tier moved over the last seconds.
+        :type tier: str
+        :type seconds: float
+        :rtype: float or None
+        '''
+        if not self.timestamps:
+            return None
+        latest = self.at(tier, self.timestamps[-1])
+        before = self.at(tier, self.timestamps[-1] - seconds)
+        return None if latest is None or before is None else latest - before
+
+    def window(self, tier, start, end):
+        '''
+        Get the (timestamp, points) of the tier between start and end.
+        :type tier: str
+        :type start: float
+        :type end: float
+        :rtype: list
+        '''
+        lo, hi = bisect_left(self.timestamps, start), bisect_right(self.timestamps, end)
+        values = self.tiers[tier]
+        return [(self.timestamps[i], values[i]) for i in range(lo, hi) if not math.isnan(values[i])]
+
+
+'''
+Public Functions
+'''
+
+def to_unix(timestamp):
+    '''
+    Convert the chart timestamp into unix time.
+    :type timestamp: int
+    :rtype: float
+    '''
+    return int(timestamp) / 1000 - OFFSET
+
+
+def project(series, end, window=FIT_WINDOW):
+    '''
+    Project the final border of every tier with a least squares line over the last window seconds.
+    :type series: BorderSeries
+    :type end: float
+    :type window: float
+    :rtype: tuple of projection_t
+    '''
+    if not series.timestamps:
+        return ()
+    start = bisect_left(series.timestamps, series.timestamps[-1] - window)
+    xs = series.timestamps[start:]
+
+    projections = []
+    for tier, values in series.tiers.items():
+        points = [(x, y) for x, y in zip(xs, values[start:]) if not math.isnan(y)]
+        n = len(points)
+        if n < FIT_MIN:
+            continue
+
+        # Fit y = a + b * x
+        mx = sum(x for x, _ in points) / n
+        my = sum(y for _, y in points) / n
+        sxx = sum((x - mx) ** 2 for x, _ in points)
+        if not sxx:
+            continue
+        b = sum((x - mx) * (y - my) for x, y in points) / sxx
+        a = my - b * mx
+
+        # Prediction interval at end
+        sse = sum((y - a - b * x) ** 2 for x, y in points)
+        se = math.sqrt(sse / (n - 2)) * math.sqrt(1 + 1 / n + (end - mx) ** 2 / sxx)
+        final = max(a + b * end, points[-1][1])
+        projections.append(projection_t(tier, final, max(final - Z * se, points[-1][1]), final + Z * se))
+    return tuple(projections)
@@ -11,10 +11,17 @@ from collections import namedtuple
 from datetime import datetime, timedelta
 import json
 import logging
+import os
 import pytz
+import re
 import requests
+import threading
+import time
 
+from . import border
 from . import happening
+from . import network
+from . import storage
 
 '''
 Definitions
@@ -34,12 +41,25 @@ URL = {
     # 'TROPHY': 'https://deresute.mon.moe/d?type=1&rank=5001+10001+{0}&event={1}',
     'TEASER': 'https://games.starlight-stage.jp/image/event/teaser/event_teaser_{0}.png',
     'BANNER': 'https://apis.game.starlight-stage.jp/image/announce/header/header_event_{0:04d}.png',
-    'BANNER_ID': 'https://deresute.mon.moe/event',
     'NEWS': 'https://apis.game.starlight-stage.jp/information/index/0/1/10/1'
 }
 
 JST = pytz.timezone('Asia/Tokyo')
 
+# Event id -> banner URL index, filled from the news posts not seen before
+BANNERS = os.path.join(os.getcwd(), 'data', 'deresute', 'banners.json')
+BANNER_POSTS = 50
+
+# Seconds to wait before looking at the news again for an event without a banner
+BANNER_RETRY = 60 * 60
+
+# Border data is collected every 15 minutes; keep the cutoffs until the next collection plus a grace period
+COLLECT_INTERVAL = timedelta(minutes=15)
+COLLECT_GRACE = timedelta(minutes=1)
+
+# Seconds to wait before asking again when a collection is late
+COLLECT_RETRY = 60
+
 BRONZE = {
     '1': '40001',   # token
     '3': '50001',   # groove
@@ -53,9 +73,30 @@ JA_MAGNITUDE = {
     '億': 100000000
 }
 
-cutoff_t = namedtuple('cutoff_t', ('name', 'collected', 'tiers'))
+cutoff_t = namedtuple('cutoff_t', ('name', 'collected', 'tiers', 'stale'))
 tier_t = namedtuple('tier_t', ('position', 'points', 'delta'))
 
+# The border chart is drawn by d3 from a JavaScript array literal returned after this marker,
+# and closed by the end of the datum function
+CHART_MARKER = "d3.select('#chart_div').append('svg')"
+CHART_END = re.compile(r'\]\s*\}\s*\)')
+CHUNK_SIZE = 16 * 1024
+
+# Latest cutoff dataset per (event_id, url_type), with the time it was fetched
+_cutoffs = {}
+
+# Border history of the current event per (event_id, url_type), and the lock every update or read of it holds
+_series = {}
+_series_locks = {}
+_series_lock = threading.Lock()
+
+# Banner index, and the last failed lookup time per event with the guessed banner served until the retry
+_banners = {'index': None, 'misses': {}}
+_banner_lock = threading.Lock()
+
+# Final border projection per (event_id, url_type), with the series timestamp it was computed at
+_projections = {}
+
 
 '''
 Exceptions
@@ -123,34 +164,110 @@ def _has_highscore(id):
     return _is_token(id) or _is_groove(id) or _is_parade(id)
 
 
-def _get_banner_id():
+def _read_banners():
     '''
-    Get banner ID.
+    Read the event banner index.
+    :rtype: dict
     '''
-    # TODO: use cache
-    resp = requests.get(URL['BANNER_ID'])
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    entries = soup.find('table', {'class': 'columns'}).findAll('tr')
-    return len(entries)
+    if os.path.isfile(BANNERS):
+        with open(BANNERS, 'r') as f:
+            return json.load(f)
+    return {'events': {}, 'posts': []}
+
+
+def _write_banners(banners):
+    '''
+    Write the event banner index.
+    :type banners: dict
+    '''
+    storage.write_json(BANNERS, banners, indent=2, ensure_ascii=False, sort_keys=True)
 
 
-def _get_banner_url():
+def _guess_banner(banners):
+    '''
+    Guess the banner URL of a new event from the latest numbered banner in the index.
+    :type banners: dict
+    :rtype: str or None
     '''
-    Get banner URL.
+    numbers = [int(m.group(1)) for m in (re.search(r'header_event_(\d+)', url) for url in banners['events'].values()) if m]
+    return URL['BANNER'].format(max(numbers) + 1) if numbers else None
+
+
+def _read_news(seen):
+    '''
+    Find the banner in the newest event news post not seen before.
+    :type seen: set, the posts looked at already
+    :rtype: (str or None, list), the banner and the new event posts
     '''
     # read posts
-    resp = requests.get(URL['NEWS'])
+    resp = network.get(URL['NEWS'])
     soup = BeautifulSoup(resp.text, 'html.parser')
     posts = soup.findAll('a', {'class': 'none'})
-    events = [post['href'] for post in posts if 'イベント' in post.text and '開催' in post.text]
-    if not events:
-        return URL['BANNER'].format(_get_banner_id())
+    events = [post['href'] for post in posts
+              if 'イベント' in post.text and '開催' in post.text and post['href'] not in seen]
 
-    # read event post
-    resp = requests.get(events[0])
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    imgs = [img['src'] for img in soup.findAll('img') if 'header_event' in img['src']]
-    return imgs[0] if imgs else URL['BANNER'].format(_get_banner_id())
+    # read the newest event post
+    url = None
+    if events:
+        resp = network.get(events[0])
+        soup = BeautifulSoup(resp.text, 'html.parser')
+        imgs = [img['src'] for img in soup.findAll('img') if 'header_event' in img['src']]
+        url = imgs[0] if imgs else None
+    return url, events
+
+
+def _index_banner(event_id):
+    '''
+    Find the banner of the event in the news posts not seen before, and add it to the index.
+    The news is read without holding the lock, so other lookups are served meanwhile.
+    :type event_id: int
+    :rtype: str or None, the guessed banner until BANNER_RETRY if no post has it
+    '''
+    with _banner_lock:
+        seen = set(_banners['index']['posts'])
+
+    try:
+        url, events = _read_news(seen)
+    except (requests.RequestException, AttributeError, KeyError) as e:
+        logging.warning('banner {0} failed: {1}'.format(event_id, e))
+        url, events = None, []
+
+    with _banner_lock:
+        banners, key = _banners['index'], str(event_id)
+        banners['posts'] = (banners['posts'] + [post for post in events if post not in banners['posts']])[-BANNER_POSTS:]
+        if url:
+            banners['events'][key] = url
+            _banners['misses'].pop(key, None)
+        if url or events:
+            _write_banners(banners)
+
+        # A guess is served, but never indexed, so a real post found later still wins
+        if not url:
+            url = _guess_banner(banners)
+            _banners['misses'][key] = (time.time(), url)
+        return url
+
+
+def _get_banner_url(event_id):
+    '''
+    Get banner URL of the event from the index, looking at new news posts only for unknown events.
+    :type event_id: int
+    :rtype: str or None
+    '''
+    with _banner_lock:
+        if _banners['index'] is None:
+            _banners['index'] = _read_banners()
+        banners = _banners['index']
+
+        key = str(event_id)
+        if key in banners['events']:
+            return banners['events'][key]
+        missed, guess = _banners['misses'].get(key, (0, None))
+        if time.time() - missed < BANNER_RETRY:
+            return guess
+
+    # Concurrent lookups of the same event wait on one read of the news
+    return network.single_flight(('banner', event_id), _index_banner, event_id)
 
 
 def _get_timeleft(timestamp):
@@ -185,65 +302,249 @@ def _get_remaining_time(timestamp):
     return time_remaining
 
 
-'''
-Public Functions
-'''
+def _get_url(event_id, url_type):
+    '''
+    Get the cutoff data url of the event, None if the url_type has no source.
+    :type event_id: int
+    :type url_type: str
+    :rtype: str or None
+    '''
+    return URL[url_type].format(str(event_id)) if url_type in URL else None
 
-def get_cutoffs(event_id, url_type, rank=None):
+
+def _get_series(event_id, url_type):
     '''
-    Get the cutoff information of the event.
+    Get the border history of the event and its lock, dropping the history of older events.
+    :type event_id: int
+    :type url_type: str
+    :rtype: (border.BorderSeries, threading.Lock)
     '''
-    if not _has_highscore(event_id):
-        raise CurrentEventNotValidError()
+    with _series_lock:
+        if (event_id, url_type) not in _series:
+            for key in [key for key in _series if key[0] != event_id]:
+                del _series[key], _series_locks[key]
+            _series[(event_id, url_type)] = border.BorderSeries(event_id)
+            _series_locks[(event_id, url_type)] = threading.Lock()
+        return _series[(event_id, url_type)], _series_locks[(event_id, url_type)]
 
-    if not _is_ranking(event_id) and url_type != 'TROPHY':
-        raise CurrentEventNotRankingError()
 
+def _extract_datum(chunks):
+    '''
+    Scan the border page incrementally for the chart's datum array, without building a DOM.
+    Stops reading as soon as the datum function is closed.
+    :type chunks: iterable of str
+    :rtype: str or None
+    '''
+    buf, pos, found = '', 0, False
+    for chunk in chunks:
+        buf += chunk
+
+        # Find the opening bracket of the array after the marker
+        if not found:
+            marker = buf.find(CHART_MARKER)
+            if marker < 0:
+                buf = buf[-len(CHART_MARKER):]
+                continue
+            start = buf.find('return', marker)
+            start = buf.find('[', start) if start >= 0 else -1
+            if start < 0:
+                buf = buf[marker:]
+                continue
+            buf, pos, found = buf[start:], 0, True
+
+        # Look for the end of the function, searching again from the last bracket as it may be cut by the chunk
+        m = CHART_END.search(buf, pos)
+        if m:
+            return buf[:m.start() + 1]
+        last = buf.rfind(']', pos)
+        pos = last if last >= 0 else len(buf)
+    return None
+
+
+def _parse_datum(text):
+    '''
+    Parse the chart's datum array into border data.
+    :type text: str
+    :rtype: list
+    '''
+    text = text.replace('area:', '"area":')
+    text = text.replace('key:', '"key":')
+    text = text.replace('values:', '"values":')
+    return json.loads(text)
+
+
+def _fetch_cutoffs(event_id, url_type):
+    '''
+    Fetch the cutoff information of the event, and keep it as the last good copy.
+    :type event_id: int
+    :type url_type: str
+    :rtype: cutoff_t or None
+    '''
     result = None
-    # TODO: cache
 
     # Fetch cutoff data
     headers = {'content-type': 'text/plain; charset=utf-8'}
-    if url_type == 'TROPHY':
-        url = URL[url_type].format(BRONZE[str(event_id)[:1]], str(event_id))
-    # elif url_type == 'PARAM' and rank != None:
-    #     url = URL[url_type].format(str(event_id), rank)
-    else:
-        url = URL[url_type].format(str(event_id))
-
-    with requests.get(url, headers=headers, stream=True) as resp:
+    url = _get_url(event_id, url_type)
+
+    with network.get(url, headers=headers, stream=True) as resp:
         if resp.status_code != 200:
             return result
 
         # Read the data from script in the html
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        text = soup.findAll('script', {"type": "text/javascript"})[3].text
-        text = text.split('d3.select(\'#chart_div\').append(\'svg\')\n\t\t\t\t.datum(function() {\n\t\t\t\t\treturn ')[1]
-        text = text.split('\n\t\t\t\t})\n\t\t\t\t.call(chart);')[0]
-        text = text.replace('area:', '"area":')
-        text = text.replace('key:', '"key":')
-        text = text.replace('values:', '"values":')
-        border_data = json.loads(text)
-
-        # Obtain the latest information
-        headers, cutoffs, deltas = [], [], []
-        for data in border_data:
-            headers.append(data['key'].split(' ')[0])
-            cutoffs.append(data['values'][-1][1])
-
-            # Find data with 1 timedelta from latest data
-            deltas.append(data['values'][-2][1] if len(data['values']) > 2 else 0)
-
-        # For some reason the timestamp is not unix epoch time and it is 9 hours ahead of it
-        lastUpdate = int(data['values'][-1][0]) / 1000
-        lastUpdate = lastUpdate - 60 * 60 * 9
+        resp.encoding = resp.encoding or 'utf-8'
+        text = _extract_datum(resp.iter_content(chunk_size=CHUNK_SIZE, decode_unicode=True))
+        if not text:
+            logging.warning('cutoffs {0} {1}: chart data not found'.format(event_id, url_type))
+            return result
+        border_data = _parse_datum(text)
+
+        # Keep the full border history, only the new points are added
+        series, lock = _get_series(event_id, url_type)
+        with lock:
+            series.extend(border_data)
+            if not len(series):
+                return result
+            lastUpdate = series.timestamps[-1]
+
+            # Obtain the latest information
+            tiers = []
+            for tier in series.tiers:
+                points = series.at(tier, lastUpdate)
+                if points is None:
+                    continue
+
+                # Find data with 1 timedelta from latest data
+                prev = series.at(tier, series.timestamps[-2]) if len(series) > 2 else 0
+                tiers.append(tier_t(tier, int(points), int(points - (prev or 0))))
 
         # Generate data
-        tiers = tuple(tier_t(x, y, y - z) for x, y, z in zip(headers, cutoffs, deltas))
-        result = cutoff_t('Event Name', pytz.utc.localize(datetime.utcfromtimestamp(lastUpdate)).astimezone(JST), tiers)
+        tiers = tuple(tiers)
+        result = cutoff_t('Event Name', pytz.utc.localize(datetime.utcfromtimestamp(lastUpdate)).astimezone(JST), tiers, None)
+        _cutoffs[(event_id, url_type)] = (result, time.time())
         return result
 
 
+def _next_collection(cutoff):
+    '''
+    Get the predicted time of the next border collection.
+    :type cutoff: cutoff_t
+    :rtype: datetime
+    '''
+    return cutoff.collected + COLLECT_INTERVAL
+
+
+def _get_fresh(event_id, url_type):
+    '''
+    Get the cached cutoff information if no new collection is expected yet.
+    :type event_id: int
+    :type url_type: str
+    :rtype: cutoff_t or None
+    '''
+    if (event_id, url_type) not in _cutoffs:
+        return None
+    cutoff, fetched = _cutoffs[(event_id, url_type)]
+    now = pytz.utc.localize(datetime.utcnow())
+    if now < _next_collection(cutoff) + COLLECT_GRACE or time.time() - fetched < COLLECT_RETRY:
+        return cutoff
+    return None
+
+
+def _get_stale(event_id, url_type):
+    '''
+    Get the last good cutoff information, marked with its age in seconds.
+    :type event_id: int
+    :type url_type: str
+    :rtype: cutoff_t or None
+    '''
+    if (event_id, url_type) not in _cutoffs:
+        return None
+    cutoff, fetched = _cutoffs[(event_id, url_type)]
+    return cutoff._replace(stale=time.time() - fetched)
+
+
+'''
+Public Functions
+'''
+
+def get_series(event_id, url_type='EVENT'):
+    '''
+    Get the border history of the event collected so far.
+    :type event_id: int
+    :type url_type: str
+    :rtype: border.BorderSeries or None
+    '''
+    return _series.get((event_id, url_type))
+
+
+def get_projection(event_id, end_date, url_type='EVENT'):
+    '''
+    Get the projected final border of the event.
+    Computed once per border collection.
+    :type event_id: int
+    :type end_date: int
+    :type url_type: str
+    :rtype: tuple of border.projection_t
+    '''
+    key = (event_id, url_type)
+    with _series_lock:
+        if key not in _series:
+            return ()
+        series, lock = _series[key], _series_locks[key]
+
+    with lock:
+        if not series:
+            return ()
+        if key not in _projections or _projections[key][0] != series.timestamps[-1]:
+            _projections[key] = (series.timestamps[-1], border.project(series, end_date))
+        return _projections[key][1]
+
+
+def get_cutoffs(event_id, url_type, rank=None):
+    '''
+    Get the cutoff information of the event.
+    Served from memory until the next border collection is due.
+    While the upstream host is down, the last good copy is returned and refreshed in the background.
+    '''
+    if not _has_highscore(event_id):
+        raise CurrentEventNotValidError()
+
+    if not _is_ranking(event_id) and url_type != 'TROPHY':
+        raise CurrentEventNotRankingError()
+
+    if not _get_url(event_id, url_type):
+        return None
+
+    cutoff = _get_fresh(event_id, url_type)
+    if not cutoff:
+        cutoff = _get_stale(event_id, url_type)
+        if cutoff and not network.is_available(_get_url(event_id, url_type)):
+            network.refresh(('cutoffs', event_id, url_type), network.single_flight, ('cutoffs', event_id, url_type),
+                            _fetch_cutoffs, event_id, url_type)
+        else:
+            # A fetch already running, e.g. the prefetch job, is waited on instead of scraping again
+            try:
+                cutoff = network.single_flight(('cutoffs', event_id, url_type), _fetch_cutoffs, event_id, url_type) or cutoff
+            except requests.RequestException as e:
+                logging.warning('cutoffs {0} {1} failed: {2}'.format(event_id, url_type, e))
+    return cutoff
+
+
+def prefetch(event_id, url_type='EVENT'):
+    '''
+    Fetch the cutoffs if a new border collection is due, so commands are served from memory.
+    :type event_id: int
+    :type url_type: str
+    :rtype: float, seconds until the next prefetch should run
+    '''
+    cutoff = get_cutoffs(event_id, url_type)
+    if not cutoff or cutoff.stale:
+        return COLLECT_RETRY
+
+    now = pytz.utc.localize(datetime.utcnow())
+    wait = (_next_collection(cutoff) + COLLECT_GRACE - now).total_seconds()
+    return max(wait, COLLECT_RETRY)
+
+
 def event_output(event):
     '''
     Parse event information into output string.
@@ -256,9 +557,8 @@ def event_output(event):
     event_time = '\n{0} - {1}'.format(s_dt.strftime('%m/%d %H:%M'), e_dt.strftime('%m/%d %H:%M %Z'))
 
     # Get Banner URL
-    # TODO: Need to fix
-    # banner = '\n' + _get_banner_url()
-    banner = ''
+    banner = _get_banner_url(event['id'])
+    banner = '\n' + banner if banner else ''
 
     # Event status
     timeleft = _get_timeleft(event['end_date'])
@@ -283,6 +583,8 @@ def cutoff_output(cutoff, unit, ended):
     # Output string
     header = 'イベントpt 順位\n' if unit == 'pts' else 'ハイスコアランキング 順位\n'
     last_update = '\n最後更新: {0} JST'.format(collect_date.strftime('%m/%d %H:%M'))
+    if cutoff.stale:
+        last_update += '\n(＊ {0} 分前のデータ ＊)'.format(int(cutoff.stale // 60))
 
     # Event ended already
     if ended:
@@ -294,5 +596,22 @@ def cutoff_output(cutoff, unit, ended):
         '#{0.position}: {0.points:,} {1} ({2}{0.delta:})'.format(tier, unit, '+' if tier.delta >= 0 else '')
         for tier in cutoff.tiers])
 
-    next_update = '\n(次の更新: {0} JST)'.format((collect_date + timedelta(minutes=15)).strftime('%H:%M'))
+    next_update = '\n(次の更新: {0} JST)'.format(_next_collection(cutoff).astimezone(JST).strftime('%H:%M'))
     return header + cutoff_content + last_update + next_update
+
+
+def projection_output(projections, unit):
+    '''
+    Parse projection data into the output string.
+    :type projections: tuple of border.projection_t
+    :type unit: str
+    :rtype: str
+    '''
+    if not projections:
+        raise NoDataCurrentlyAvailableError()
+
+    header = '最終ボーダー予想\n'
+    projection_content = '\n'.join([
+        '#{0.position}: {1:,} {2} ({3:,} - {4:,})'.format(p, int(p.points), unit, int(p.low), int(p.high))
+        for p in projections])
+    return header + projection_content
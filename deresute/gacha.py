@@ -6,10 +6,17 @@ Github: https://github.com/maplemist
 Telegram: @maplemist
 '''
 
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import json
+import os
 import pytz
+import threading
 
 from . import happening
+from . import network
+from . import storage
 
 '''
 Definitions
@@ -25,6 +32,28 @@ TYPE = {
     'rerun': '復刻',
     'select': 'タイプセレクト'
 }
+ATTRIBUTES = ('Cute', 'Cool', 'Passion')
+
+# Ordered index of the main gacha of every period, with its derived kind
+TIMELINE = os.path.join(os.getcwd(), 'data', 'deresute', 'gachas.json')
+
+# Number of earlier gachas get_next needs to look at
+HISTORY = 3
+
+# Number of pools whose banners are resolved at the same time
+WORKERS = 4
+
+_timeline = {'entries': None, 'ids': {}}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=WORKERS)
+
+
+'''
+Exceptions
+'''
+
+class HistoryNotAvailableError(Exception):
+    pass
 
 
 '''
@@ -40,32 +69,146 @@ def _prev_timestamp(timestamp):
     return str(int(timestamp) - 1000)
 
 
+def _get_kind(gacha):
+    '''
+    Get the kind of the gacha from its name.
+    :type gacha: dict
+    :rtype: str
+    '''
+    if TYPE['rerun'] in gacha['name']:
+        return 'rerun'
+    elif TYPE['select'] in gacha['name']:
+        return 'select'
+    return 'general'
+
+
+def _load_timeline():
+    '''
+    Get the timeline entries, reading them from file the first time.
+    :rtype: list
+    '''
+    if _timeline['entries'] is None:
+        entries = []
+        if os.path.isfile(TIMELINE):
+            with open(TIMELINE, 'r') as f:
+                entries = json.load(f)
+        _timeline['entries'] = entries
+        _timeline['ids'] = {entry['id']: i for i, entry in enumerate(entries)}
+    return _timeline['entries']
+
+
+def _write_timeline(entries):
+    '''
+    Write the timeline entries to file.
+    :type entries: list
+    '''
+    storage.write_json(TIMELINE, entries, indent=2, ensure_ascii=False)
+
+
+def _insert(entries, gacha):
+    '''
+    Insert the gacha into the timeline in start_date order, deriving its kind and Type Select offset.
+    :type entries: list
+    :type gacha: dict
+    '''
+    index = bisect_right([entry['start_date'] for entry in entries], gacha['start_date'])
+    entry = {key: gacha[key] for key in ('id', 'name', 'start_date', 'end_date')}
+    entry['kind'] = _get_kind(gacha)
+
+    # Type Select offset: 0 (Cute), -1 (Cool), -2 (Passion)
+    offset = 0
+    if entry['kind'] == 'select':
+        while index + offset > 0 and entries[index + offset - 1]['kind'] == 'select':
+            offset -= 1
+    entry['offset'] = offset
+    entries.insert(index, entry)
+
+
+def _extend(gacha):
+    '''
+    Add the gacha and the history it needs to the timeline.
+    The history is looked up without holding the lock, so other pools can be resolved meanwhile.
+    Nothing is added if a lookup fails, so a half walked history is never stored.
+    :type gacha: dict
+    '''
+    with _lock:
+        _load_timeline()
+        known = set(_timeline['ids'])
+
+    # Walk back until a known gacha or the first one, at least HISTORY deep and out of any Type Select run
+    walked = [gacha]
+    while len(walked) <= HISTORY or _get_kind(walked[-1]) == 'select':
+        prev = happening.at(_prev_timestamp(walked[-1]['start_date']))
+        if not prev:
+            return
+        if not prev['gachas'] or prev['gachas'][0]['id'] in known:
+            break
+        walked.append(prev['gachas'][0])
+
+    with _lock:
+        entries = _load_timeline()
+        for entry in reversed(walked):
+            if entry['id'] not in _timeline['ids']:
+                _insert(entries, entry)
+                _timeline['ids'] = {entry['id']: i for i, entry in enumerate(entries)}
+        _write_timeline(entries)
+
+
+def _get_entries(gacha):
+    '''
+    Get copies of the timeline entry of the gacha and of the HISTORY entries before it, latest first.
+    Missing entries before the start of the timeline have kind None.
+    :type gacha: dict
+    :rtype: list of dict
+    :raises HistoryNotAvailableError: the history could not be looked up, try again later
+    '''
+    with _lock:
+        _load_timeline()
+        known = gacha['id'] in _timeline['ids']
+    if not known:
+        network.single_flight(('gacha', gacha['id']), _extend, gacha)
+
+    with _lock:
+        entries = _timeline['entries']
+        index = _timeline['ids'].get(gacha['id'])
+        if index is None:
+            raise HistoryNotAvailableError('history of gacha {0} could not be looked up'.format(gacha['id']))
+        return [dict(entries[index - i]) if index - i >= 0 else {'kind': None} for i in range(HISTORY + 1)]
+
+
 def _get_banner(gacha):
     '''
     Get the banner of the gacha.
     :type gacha: dict
     :rtype: str
     '''
+    kind = _get_kind(gacha)
+
     # Reruns
-    if TYPE['rerun'] in gacha['name']:
+    if kind == 'rerun':
         return BANNER['rerun'].format(str(gacha['id'])[1:])
 
     # Type Select
-    elif TYPE['select'] in gacha['name']:
-        offset = 0
-        prev = happening.at(_prev_timestamp(gacha['start_date']))
-        prev = prev['gachas'][0]
-        while TYPE['select'] in prev['name']:
-            offset -= 1
-            prev = happening.at(_prev_timestamp(prev['start_date']))
-            prev = prev['gachas'][0]
-        gacha['name'] += ' (Cute)' if offset == 0 else ' (Cool)' if offset == -1 else ' (Passion)'
+    elif kind == 'select':
+        offset = _get_entries(gacha)[0]['offset']
+        gacha['name'] += ' ({0})'.format(ATTRIBUTES[min(-offset, 2)])
         return BANNER['gacha'].format(str(gacha['id'] + offset)[1:])
 
     # General
     return BANNER['gacha'].format(str(gacha['id'])[1:])
 
 
+def _get_content(gacha):
+    '''
+    Get the name and banner of the gacha, without touching the cached happening data.
+    :type gacha: dict
+    :rtype: str
+    '''
+    gacha = dict(gacha)
+    banner = _get_banner(gacha)
+    return '{0[name]}\n{1}'.format(gacha, banner)
+
+
 def _get_timeleft(timestamp):
     '''
     Get time remaining from timestamp.
@@ -102,6 +245,18 @@ def _get_remaining_time(timestamp):
 Public Functions
 '''
 
+def get_name(id):
+    '''
+    Get the name of the gacha from the timeline.
+    :type id: int
+    :rtype: str or None
+    '''
+    with _lock:
+        entries = _load_timeline()
+        index = _timeline['ids'].get(id)
+        return entries[index]['name'] if index is not None else None
+
+
 def get_curr(gachas):
     '''
     Parse the gacha data into the output string.
@@ -111,13 +266,8 @@ def get_curr(gachas):
     # Get remaining time string
     time_remaining = _get_remaining_time(gachas[0]['end_date'])
 
-    # Put gachas into list
-    results = []
-    for gacha in gachas:
-        banner = _get_banner(gacha)
-        gacha_content = '{0[name]}\n{1}'.format(gacha, banner)
-        results.append(gacha_content + time_remaining)
-    return results
+    # Resolve the banners of all pools at once
+    return [gacha_content + time_remaining for gacha_content in _executor.map(_get_content, gachas)]
 
 
 def get_next(gachas):
@@ -134,28 +284,28 @@ def get_next(gachas):
         return None
 
     minutes = (timeleft.seconds // 60) % 60
+    return preview_next(gachas, minutes)
+
+
+def preview_next(gachas, minutes):
+    '''
+    Get the next gacha data into the output string, announcing the change in minutes.
+    :type gachas: list
+    :type minutes: int
+    :rtype: list
+    '''
     results = ["次のガシャまであと {0} 分\nプロデューサーさん、準備はいいですか？".format(minutes)]
 
-    # Try to get previous gacha
+    # Look up the previous gachas in the timeline
     gacha = gachas[0]
-    prev = happening.at(_prev_timestamp(gacha['start_date']))
-    prev = prev['gachas'][0]
-    pprev = happening.at(_prev_timestamp(prev['start_date']))
-    pprev = pprev['gachas'][0]
+    entry, prev, pprev, ppprev = _get_entries(gacha)
 
     # Current is Type Select
-    if TYPE['select'] in gacha['name']:
-        # Check the offset
-        offset = 0
-        while TYPE['select'] in prev['name']:
-            offset -= 1
-            prev = happening.at(_prev_timestamp(prev['start_date']))
-            prev = prev['gachas'][0]
-
+    if entry['kind'] == 'select':
         # Current is Cute or Cool
-        if offset in [0, -1]:
+        if entry['offset'] in [0, -1]:
             # Adding next type to gacha name
-            next_type = ' (Cool)' if offset == 0 else ' (Passion)'
+            next_type = ' (Cool)' if entry['offset'] == 0 else ' (Passion)'
             results[0] += '\n次の' + gacha['name'].split('ガシャ')[0] + next_type
 
         # Current is Passion
@@ -167,14 +317,12 @@ def get_next(gachas):
 
     next_id = gacha['id'] + 1
     # 3rd general pool of the month (Current is general, and previous is type select)
-    if TYPE['select'] in [prev['name'], pprev['name']]:
+    if 'select' in [prev['kind'], pprev['kind']]:
         results[0] += '\n' + BANNER['gacha'].format(str(next_id)[1:])
         return results
 
     # Rerun next (current is general, 2nd previous is type select)
-    pprev = happening.at(_prev_timestamp(pprev['start_date']))
-    pprev = pprev['gachas'][0]
-    if TYPE['select'] in pprev['name']:
+    if ppprev['kind'] == 'select':
         results.append(BANNER['rerun'].format(str(next_id)[1:]))
         results.append(BANNER['rerun'].format(str(next_id + 1)[1:]))
         results.append(BANNER['rerun'].format(str(next_id + 2)[1:]))
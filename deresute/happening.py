@@ -6,9 +6,17 @@ Github: https://github.com/maplemist
 Telegram: @maplemist
 '''
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import copy
 import json
 import logging
+import os
 import requests
+import threading
+import time
+
+from . import network
+from . import storage
 
 
 URL = {
@@ -16,6 +24,227 @@ URL = {
     '346LAB': 'http://starlight.346lab.org/api/v1/happening/{0}?extended_time_period_for_events=yes'
 }
 
+# Snapshots of past timestamps never change, so they are kept on disk
+DIR = os.path.join(os.getcwd(), 'data', 'deresute', 'happening')
+
+# Seconds to keep the 'now' status before asking upstream again
+TTL = 60
+
+# Race the next mirror if the current one has not answered within HEDGE_AFTER seconds
+HEDGE = True
+HEDGE_AFTER = 1.0
+
+# Weight of the newest sample in a mirror's latency score, and the latency charged for a failure
+SCORE_WEIGHT = 0.3
+FAILURE_PENALTY = 10.0
+
+_cache = {'status': None, 'expires': 0}
+_last_good = {'status': None, 'fetched': 0}
+_snapshots = {}
+_stats = {'hits': 0, 'misses': 0}
+_scores = {mirror: 0.0 for mirror in URL}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=2 * len(URL))
+
+# Functions called with the gacha ids that show up for the first time, and the ids seen so far
+_listeners = []
+_gachas = set()
+
+
+'''
+Private Functions
+'''
+
+def _next_boundary(status):
+    '''
+    Get the earliest end_date of the events and gachas in status that is still in the future.
+    :type status: dict
+    :rtype: float or None
+    '''
+    current = time.time()
+    ends = [happening['end_date'] for key in ('events', 'gachas')
+            for happening in status.get(key, []) if happening['end_date'] > current]
+    return min(ends) if ends else None
+
+
+def _is_historical(timestamp):
+    '''
+    Check whether the status at timestamp can no longer change.
+    :type timestamp: str
+    :rtype: bool
+    '''
+    try:
+        return int(timestamp) < time.time()
+    except ValueError:
+        return False
+
+
+def _read_snapshot(timestamp):
+    '''
+    Read the stored status at timestamp.
+    :type timestamp: str
+    :rtype: dict or None
+    '''
+    if timestamp in _snapshots:
+        return _snapshots[timestamp]
+
+    filepath = os.path.join(DIR, '{0}.json'.format(timestamp))
+    if os.path.isfile(filepath):
+        with open(filepath, 'r') as f:
+            _snapshots[timestamp] = json.load(f)
+        return _snapshots[timestamp]
+    return None
+
+
+def _write_snapshot(timestamp, status):
+    '''
+    Store the status at timestamp.
+    :type timestamp: str
+    :type status: dict
+    '''
+    filepath = os.path.join(DIR, '{0}.json'.format(timestamp))
+    storage.write_json(filepath, status, separators=(',', ':'), ensure_ascii=False)
+    _snapshots[timestamp] = status
+
+
+def _mirrors():
+    '''
+    Get the mirrors ordered by their latency score, best first.
+    :rtype: list
+    '''
+    with _lock:
+        return sorted(URL, key=lambda mirror: _scores[mirror])
+
+
+def _update_score(mirror, elapsed, ok):
+    '''
+    Fold a request result into the latency score of the mirror.
+    :type mirror: str
+    :type elapsed: float
+    :type ok: bool
+    '''
+    sample = elapsed if ok else elapsed + FAILURE_PENALTY
+    with _lock:
+        _scores[mirror] += SCORE_WEIGHT * (sample - _scores[mirror])
+
+
+def _request(mirror, timestamp):
+    '''
+    Get status at timestamp from one mirror.
+    :type mirror: str
+    :type timestamp: str
+    :rtype: dict or None
+    '''
+    status = None
+    headers = {'content-type': 'application/json'}
+    start = time.time()
+    try:
+        r = network.get(URL[mirror].format(timestamp), headers=headers)
+        if r.status_code == 200:
+            status = json.loads(r.text)
+    except (requests.RequestException, ValueError) as e:
+        logging.warning('happening {0} failed: {1}'.format(mirror, e))
+    _update_score(mirror, time.time() - start, status is not None)
+    return status
+
+
+def _fetch(timestamp):
+    '''
+    Get status at timestamp from the API endpoints.
+    :type timestamp: str
+    :rtype: dict
+    '''
+    logging.info('happening at: {0}'.format(timestamp))
+    mirrors = _mirrors()
+
+    # Sequential fallback
+    if not HEDGE:
+        for mirror in mirrors:
+            status = _request(mirror, timestamp)
+            if status:
+                return status
+        return None
+
+    # Hedged: start the next mirror whenever the ones in flight are slow or failed
+    pending = set()
+    while mirrors or pending:
+        if mirrors:
+            pending.add(_executor.submit(_request, mirrors.pop(0), timestamp))
+        done, pending = wait(pending, timeout=HEDGE_AFTER if mirrors else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.result():
+                return future.result()
+    return None
+
+
+def _fetch_snapshot(timestamp):
+    '''
+    Fetch the status at a past timestamp and store it.
+    :type timestamp: str
+    :rtype: dict
+    '''
+    status = _read_snapshot(timestamp)
+    if status is None:
+        status = _fetch(timestamp)
+        if status:
+            _write_snapshot(timestamp, status)
+    return status
+
+
+def _refresh(ttl):
+    '''
+    Fetch the current status and store it in the cache.
+    :type ttl: int
+    :rtype: dict
+    '''
+    status = at('now')
+    if status:
+        expires = time.time() + ttl
+        boundary = _next_boundary(status)
+        with _lock:
+            _cache['status'] = status
+            _cache['expires'] = min(expires, boundary) if boundary else expires
+            _last_good['status'], _last_good['fetched'] = status, time.time()
+        _notify(status)
+    return status
+
+
+def _notify(status):
+    '''
+    Call the listeners with the gacha ids in status that were not seen before.
+    :type status: dict
+    '''
+    with _lock:
+        ids = [gacha['id'] for gacha in status.get('gachas', []) if gacha['id'] not in _gachas]
+        _gachas.update(ids)
+    if not ids:
+        return
+
+    for listener in _listeners:
+        try:
+            listener(ids)
+        except Exception as e:
+            logging.warning('happening listener {0} failed: {1}'.format(listener, e))
+
+
+def _stale():
+    '''
+    Get a copy of the last good status, marked with its age in seconds under 'stale'.
+    :rtype: dict or None
+    '''
+    if _last_good['status'] is None:
+        return None
+    return dict(_last_good['status'], stale=time.time() - _last_good['fetched'])
+
+
+def _is_down():
+    '''
+    Check whether the circuits of all mirrors are open.
+    :rtype: bool
+    '''
+    return not any(network.is_available(URL[mirror]) for mirror in URL)
+
+
 '''
 Public Functions
 '''
@@ -23,23 +252,68 @@ Public Functions
 def at(time):
     '''
     Get status at the specific time.
+    Past timestamps are fetched once and then served from the local snapshot store.
     :type time: 'now' or timestamp
     :rtype: dict
     '''
-    logging.info('happening at: {0}'.format(time))
-    status = None
-    headers = {'content-type': 'application/json'}
-    for url in URL:
-        r = requests.get(URL[url].format(time), headers=headers)
-        if r.status_code == 200:
-            status = json.loads(r.text)
-            break
+    time = str(time)
+    if not _is_historical(time):
+        return _fetch(time)
+
+    status = _read_snapshot(time)
+    if status is None:
+        status = network.single_flight(('happening', time), _fetch_snapshot, time)
     return status
 
 
-def now():
+def now(ttl=None):
     '''
     Get current information.
+    Cached for ttl seconds, or until the next event / gacha ends, whichever comes first.
+    While the mirrors are down, the last good status is served with a 'stale' age in seconds.
+    Every caller gets its own copy, so the cached status cannot be changed through it.
+    :type ttl: int or None
+    :rtype: dict
+    '''
+    ttl = TTL if ttl is None else ttl
+    with _lock:
+        if _cache['status'] is not None and time.time() < _cache['expires']:
+            _stats['hits'] += 1
+            return copy.deepcopy(_cache['status'])
+        _stats['misses'] += 1
+        stale = _stale()
+
+    # Answer at once, and let a background refresh revalidate
+    if stale and _is_down():
+        network.refresh('happening', network.single_flight, ('happening', 'now'), _refresh, ttl)
+        return copy.deepcopy(stale)
+
+    status = network.single_flight(('happening', 'now'), _refresh, ttl)
+    return copy.deepcopy(status if status else stale)
+
+
+def listen(func):
+    '''
+    Call func with the list of new gacha ids whenever the current status shows gachas not seen before.
+    The listener runs on the refreshing thread, so it should hand heavy work off.
+    :type func: function
+    '''
+    _listeners.append(func)
+
+
+def invalidate():
+    '''
+    Drop the cached 'now' status, so the next call goes upstream.
+    '''
+    with _lock:
+        _cache['status'] = None
+        _cache['expires'] = 0
+
+
+def stats():
+    '''
+    Get cache hit / miss counters and mirror latency scores.
     :rtype: dict
     '''
-    return at('now')
+    with _lock:
+        return dict(_stats, scores=dict(_scores))
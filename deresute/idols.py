@@ -0,0 +1,280 @@
+'''
+idols.py - .py file to search idol names in Romaji, Kanji and kana
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+from itertools import combinations
+import collections
+import csv
+import json
+import os
+import re
+import threading
+
+
+'''
+Definitions
+'''
+
+NAMES = os.path.join(os.getcwd(), 'data', 'deresute', 'names.csv')
+BIRTHDAYS = os.path.join(os.getcwd(), 'data', 'deresute', 'birthdays.json')
+
+# Typos tolerated in a query shorter than LONG_QUERY, and in a longer one
+TYPOS = 1
+LONG_TYPOS = 2
+LONG_QUERY = 5
+
+# Results returned by search
+LIMIT = 5
+
+# Hiragana to Hepburn romaji, single kana and two kana combinations
+KANA = dict(zip(
+    'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん'
+    'がぎぐげござじずぜぞだぢづでどばびぶべぼぱぴぷぺぽぁぃぅぇぉゃゅょゎ',
+    ('a i u e o ka ki ku ke ko sa shi su se so ta chi tsu te to na ni nu ne no ha hi fu he ho '
+     'ma mi mu me mo ya yu yo ra ri ru re ro wa wo n '
+     'ga gi gu ge go za ji zu ze zo da ji zu de do ba bi bu be bo pa pi pu pe po a i u e o ya yu yo wa').split()))
+KANA.update({
+    'きゃ': 'kya', 'きゅ': 'kyu', 'きょ': 'kyo', 'しゃ': 'sha', 'しゅ': 'shu', 'しょ': 'sho',
+    'ちゃ': 'cha', 'ちゅ': 'chu', 'ちょ': 'cho', 'にゃ': 'nya', 'にゅ': 'nyu', 'にょ': 'nyo',
+    'ひゃ': 'hya', 'ひゅ': 'hyu', 'ひょ': 'hyo', 'みゃ': 'mya', 'みゅ': 'myu', 'みょ': 'myo',
+    'りゃ': 'rya', 'りゅ': 'ryu', 'りょ': 'ryo', 'ぎゃ': 'gya', 'ぎゅ': 'gyu', 'ぎょ': 'gyo',
+    'じゃ': 'ja', 'じゅ': 'ju', 'じょ': 'jo', 'びゃ': 'bya', 'びゅ': 'byu', 'びょ': 'byo',
+    'ぴゃ': 'pya', 'ぴゅ': 'pyu', 'ぴょ': 'pyo', 'ふぁ': 'fa', 'ふぃ': 'fi', 'ふぇ': 'fe', 'ふぉ': 'fo',
+    'てぃ': 'ti', 'でぃ': 'di', 'しぇ': 'she', 'じぇ': 'je', 'ちぇ': 'che', 'うぃ': 'wi', 'うぇ': 'we',
+})
+
+idol_t = collections.namedtuple('idol_t', ('name', 'romaji', 'kind'))
+
+# Idols, Romaji to Kanji, and the keys: exact, every prefix, every prefix from inside the Kanji name,
+# and every deletion within LONG_TYPOS
+_index = {'idols': None, 'romaji': {}, 'exact': {}, 'prefixes': {}, 'infixes': {}, 'deletions': {}}
+_lock = threading.Lock()
+
+
+'''
+Private Functions
+'''
+
+def _to_hiragana(text):
+    '''
+    Turn the katakana in text into hiragana.
+    :type text: str
+    :rtype: str
+    '''
+    return ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text)
+
+
+def _to_romaji(text):
+    '''
+    Turn the hiragana in text into Hepburn romaji, leaving other characters as they are.
+    :type text: str
+    :rtype: str
+    '''
+    results, i = [], 0
+    while i < len(text):
+        # Small tsu doubles the next consonant
+        if text[i] == 'っ' and i + 1 < len(text):
+            syllable = KANA.get(text[i + 1:i + 3]) or KANA.get(text[i + 1], '')
+            results.append(syllable[:1])
+            i += 1
+        elif text[i:i + 2] in KANA:
+            results.append(KANA[text[i:i + 2]])
+            i += 2
+        else:
+            results.append(KANA.get(text[i], text[i]))
+            i += 1
+    return ''.join(results)
+
+
+def _fold(text):
+    '''
+    Fold a name or query into a key: kana into romaji, lower case, no separators, no long vowels.
+    :type text: str
+    :rtype: str
+    '''
+    text = _to_romaji(_to_hiragana(text.lower()))
+    text = re.sub(r'[\s・.\-ー]', '', text)
+    text = re.sub(r'o[ou]', 'o', text.replace('uu', 'u'))
+    return text.replace('sy', 'sh')
+
+
+def _get_keys(idol):
+    '''
+    Get the keys of the idol: the whole names and the Romaji parts.
+    :type idol: idol_t
+    :rtype: set
+    '''
+    keys = {_fold(idol.name)}
+    if idol.romaji:
+        keys.add(_fold(idol.romaji))
+        keys.update(_fold(part) for part in idol.romaji.split())
+    return keys
+
+
+def _get_deletions(key, distance):
+    '''
+    Get key with every choice of up to distance characters deleted.
+    :type key: str
+    :type distance: int
+    :rtype: set
+    '''
+    deletions = {key}
+    for n in range(1, min(distance, len(key) - 1) + 1):
+        for positions in combinations(range(len(key)), n):
+            deletions.add(''.join(c for i, c in enumerate(key) if i not in positions))
+    return deletions
+
+
+def _get_distance(a, b):
+    '''
+    Get the edit distance between a and b, counting a swap of neighbours as one.
+    :type a: str
+    :type b: str
+    :rtype: int
+    '''
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        curr = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            curr[j] = min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                curr[j] = min(curr[j], prev2[j - 2] + 1)
+        prev2, prev = prev, curr
+    return prev[-1]
+
+
+def _read_idols():
+    '''
+    Read the idols from names.csv, and the idols and voice actors from birthdays.json.
+    :rtype: list of idol_t
+    '''
+    idols, seen = [], set()
+    with open(NAMES, newline='\n') as f:
+        # ['Sagisawa Fumika', '鷺沢文香']
+        for row in csv.DictReader(f, delimiter=','):
+            idols.append(idol_t(row['Name'], row['Romaji'], 'CHAR'))
+            seen.add(row['Name'])
+
+    if os.path.isfile(BIRTHDAYS):
+        with open(BIRTHDAYS, 'r') as f:
+            data = json.load(f)
+        for kind in ('CHAR', 'CV'):
+            for name in sorted(name for days in data.get(kind, {}).values() for names in days.values() for name in names):
+                if name not in seen:
+                    idols.append(idol_t(name, None, kind))
+                    seen.add(name)
+    return idols
+
+
+def _get_index():
+    '''
+    Get the search index, building it the first time.
+    :rtype: dict
+    '''
+    with _lock:
+        if _index['idols'] is not None:
+            return _index
+
+        idols = _read_idols()
+        exact, prefixes, infixes, deletions = (collections.defaultdict(set) for _ in range(4))
+        for i, idol in enumerate(idols):
+            for key in _get_keys(idol):
+                exact[key].add(i)
+                for n in range(1, len(key) + 1):
+                    prefixes[key[:n]].add(i)
+                for deletion in _get_deletions(key, LONG_TYPOS):
+                    deletions[deletion].add(key)
+
+            # The given name inside a Kanji name, e.g. 文香 in 鷺沢文香
+            name = _fold(idol.name)
+            for start in range(1, len(name)):
+                for n in range(start + 1, len(name) + 1):
+                    infixes[name[start:n]].add(i)
+
+        _index.update(romaji={idol.romaji: idol.name for idol in idols if idol.romaji},
+                      exact=dict(exact), prefixes=dict(prefixes), infixes=dict(infixes), deletions=dict(deletions))
+        _index['idols'] = idols
+        return _index
+
+
+def _get_fuzzy(index, query):
+    '''
+    Get the ids of the idols with a key within the typo distance of the query, with their distance.
+    :type index: dict
+    :type query: str
+    :rtype: dict
+    '''
+    distance = LONG_TYPOS if len(query) >= LONG_QUERY else TYPOS
+    keys = set()
+    for deletion in _get_deletions(query, distance):
+        keys.update(index['deletions'].get(deletion, ()))
+
+    results = {}
+    for key in keys:
+        d = _get_distance(query, key)
+        if d <= distance:
+            for i in index['exact'][key]:
+                results[i] = min(d, results.get(i, d))
+    return results
+
+
+'''
+Public Functions
+'''
+
+def load():
+    '''
+    Build the search index ahead of the first query.
+    '''
+    _get_index()
+
+
+def translate(name):
+    '''
+    Translate a Romaji name into its Kanji name, leaving unknown names as they are.
+    :type name: str
+    :rtype: str
+    '''
+    return _get_index()['romaji'].get(name, name)
+
+
+def search(query, limit=LIMIT):
+    '''
+    Search idols by name: exact matches first, then prefix matches, then matches inside a Kanji name,
+    and only if none of those, names within a typo or two.
+    :type query: str, Romaji, Kanji or kana, whole or the beginning of the family / given name
+    :type limit: int
+    :rtype: list of idol_t
+    '''
+    index = _get_index()
+    query = _fold(query)
+    if not query:
+        return []
+
+    exact = index['exact'].get(query, set())
+    prefix = index['prefixes'].get(query, set())
+    infix = index['infixes'].get(query, set())
+    if prefix or infix:
+        ranks = {i: 2 for i in infix}
+        ranks.update({i: (0 if i in exact else 1) for i in prefix})
+    else:
+        ranks = {i: 3 + d for i, d in _get_fuzzy(index, query).items()}
+
+    idols = index['idols']
+    return [idols[i] for i in sorted(ranks, key=lambda i: (ranks[i], idols[i].kind, i))[:limit]]
+
+
+def output(query):
+    '''
+    Get the message listing the idols matching the query.
+    :type query: str
+    :rtype: str or None
+    '''
+    idols = search(query)
+    if not idols:
+        return None
+    return '\n'.join('{0} ({1})'.format(idol.name, idol.romaji) if idol.romaji else idol.name for idol in idols)
@@ -0,0 +1,208 @@
+'''
+network.py - .py file to share pooled keep-alive connections to the upstream hosts.
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import logging
+import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+
+'''
+Definitions
+'''
+
+# (connect, read) timeout in seconds, so a hanging host cannot hang a command
+TIMEOUT = (3.05, 10)
+
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+# Open the circuit of a host after FAILURES consecutive failures, and try it again after COOLDOWN seconds
+FAILURES = 3
+COOLDOWN = 60
+
+_breakers = {}
+_refreshing = set()
+_inflight = {}
+_lock = threading.Lock()
+
+
+'''
+Exceptions
+'''
+
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+'''
+Private Functions
+'''
+
+def _host(url):
+    '''
+    Get the host of the url.
+    :type url: str
+    :rtype: str
+    '''
+    return urlparse(url).netloc
+
+
+def _breaker(host):
+    '''
+    Get the circuit breaker state of the host.
+    :type host: str
+    :rtype: dict
+    '''
+    return _breakers.setdefault(host, {'failures': 0, 'opened': None})
+
+
+def _allow(host):
+    '''
+    Check whether a request to the host may go out.
+    After the cooldown one trial request is let through, and the cooldown starts over.
+    :type host: str
+    :rtype: bool
+    '''
+    with _lock:
+        breaker = _breaker(host)
+        if breaker['opened'] is None:
+            return True
+        if time.time() - breaker['opened'] >= COOLDOWN:
+            breaker['opened'] = time.time()
+            return True
+        return False
+
+
+def _record(host, ok):
+    '''
+    Record the result of a request to the host.
+    :type host: str
+    :type ok: bool
+    '''
+    with _lock:
+        breaker = _breaker(host)
+        if ok:
+            breaker['failures'], breaker['opened'] = 0, None
+            return
+        breaker['failures'] += 1
+        if breaker['failures'] >= FAILURES and breaker['opened'] is None:
+            logging.warning('circuit opened: {0}'.format(host))
+            breaker['opened'] = time.time()
+
+
+class _Flight(object):
+    '''
+    A request in progress that other callers can wait on.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def _run_refresh(key, func, args):
+    '''
+    Run a background refresh, and allow the next one for key afterwards.
+    :type key: hashable
+    :type func: function
+    :type args: tuple
+    '''
+    try:
+        func(*args)
+    except Exception as e:
+        logging.warning('background refresh {0} failed: {1}'.format(key, e))
+    finally:
+        with _lock:
+            _refreshing.discard(key)
+
+
+'''
+Public Functions
+'''
+
+def get(url, **kwargs):
+    '''
+    Send a GET request through the shared session.
+    Raises CircuitOpenError at once if the host is marked bad.
+    :type url: str
+    :rtype: requests.Response
+    '''
+    host = _host(url)
+    if not _allow(host):
+        raise CircuitOpenError('circuit open: {0}'.format(host))
+
+    kwargs.setdefault('timeout', TIMEOUT)
+    try:
+        resp = SESSION.get(url, **kwargs)
+    except requests.RequestException:
+        _record(host, False)
+        raise
+    _record(host, resp.status_code < 500)
+    return resp
+
+
+def is_available(url):
+    '''
+    Check whether the circuit of the url's host is closed.
+    :type url: str
+    :rtype: bool
+    '''
+    with _lock:
+        return _breaker(_host(url))['opened'] is None
+
+
+def single_flight(key, func, *args):
+    '''
+    Run func(*args) once for all concurrent callers with the same key, the others wait for its result.
+    :type key: hashable
+    :type func: function
+    :rtype: return value of func
+    '''
+    with _lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+
+    # Someone else is already asking upstream, wait for their answer
+    if not leader:
+        flight.done.wait()
+        return flight.result
+
+    try:
+        flight.result = func(*args)
+    finally:
+        with _lock:
+            del _inflight[key]
+        flight.done.set()
+    return flight.result
+
+
+def refresh(key, func, *args):
+    '''
+    Run func(*args) in a background thread, unless a refresh for key is already running.
+    :type key: hashable
+    :type func: function
+    '''
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    threading.Thread(target=_run_refresh, args=(key, func, args), daemon=True).start()
+
+
+def stats():
+    '''
+    Get the circuit breaker state of every host seen so far.
+    :rtype: dict
+    '''
+    with _lock:
+        return {host: dict(breaker) for host, breaker in _breakers.items()}
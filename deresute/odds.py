@@ -0,0 +1,114 @@
+'''
+odds.py - .py file to compute exact gacha outcome distributions
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import collections
+import functools
+
+from . import roller
+
+
+'''
+Definitions
+'''
+
+odds_t = collections.namedtuple('odds_t', ('rolls', 'lim_ssr', 'ssr'))
+
+
+'''
+Private Functions
+'''
+
+def _binomial(n, p):
+    '''
+    Get the distribution of hits in n rolls with hit probability p.
+    :type n: int
+    :type p: float
+    :rtype: list
+    '''
+    if p <= 0:
+        return [1.0] + [0.0] * n
+    if p >= 1:
+        return [0.0] * n + [1.0]
+
+    pmf = [(1 - p) ** n]
+    ratio = p / (1 - p)
+    for i in range(n):
+        pmf.append(pmf[-1] * (n - i) / (i + 1) * ratio)
+    return pmf
+
+
+def _convolve(a, b):
+    '''
+    Get the distribution of the sum of two independent counts.
+    :type a: list
+    :type b: list
+    :rtype: list
+    '''
+    result = [0.0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        if x:
+            for j, y in enumerate(b):
+                result[i + j] += x * y
+    return result
+
+
+@functools.lru_cache(maxsize=256)
+def _distribution(total, p, q):
+    '''
+    Get the distribution of hits in total rolls, where every 10th roll has probability q instead of p.
+    :type total: int
+    :type p: float
+    :type q: float
+    :rtype: tuple
+    '''
+    k = total // 10
+    return tuple(_convolve(_binomial(total - k, p), _binomial(k, q)))
+
+
+'''
+Public Functions
+'''
+
+def get_odds(id, total):
+    '''
+    Get the exact distributions of limited SSR and SSR counts in total rolls of the pool.
+    :type id: int
+    :type total: int
+    :rtype: odds_t or None
+    '''
+    pool = roller.get_pool(id)
+    if not pool:
+        return None
+
+    # Probability of each rarity class on a normal and a 10th roll, rates are weights like in the roller
+    cards = [roller.get_card(card) for card in pool.cards]
+    lim = [i for i, card in enumerate(cards) if card.rarity == 'SSR' and card.lim]
+    ssr = [i for i, card in enumerate(cards) if card.rarity == 'SSR']
+    rate, sp_rate = sum(pool.rate), sum(pool.sp_rate)
+    return odds_t(total,
+                  _distribution(total, sum(pool.rate[i] for i in lim) / rate, sum(pool.sp_rate[i] for i in lim) / sp_rate),
+                  _distribution(total, sum(pool.rate[i] for i in ssr) / rate, sum(pool.sp_rate[i] for i in ssr) / sp_rate))
+
+
+def output(gacha, total):
+    '''
+    Get the odds message of rolling the gacha pool total times.
+    :type gacha: dict
+    :type total: int
+    :rtype: str or None
+    '''
+    odds = get_odds(gacha['id'], total)
+    if not odds:
+        return None
+
+    results = '{0[name]}\n{1} 連'.format(gacha, total)
+    for name, pmf in (('限定SSR', odds.lim_ssr), ('SSR', odds.ssr)):
+        mean = sum(n * p for n, p in enumerate(pmf))
+        mode = max(range(len(pmf)), key=pmf.__getitem__)
+        results += '\n{0}: 1枚以上 {1:.1%} / 期待値 {2:.2f} 枚 / 最頻 {3} 枚'.format(name, 1 - pmf[0], mean, mode)
+    return results
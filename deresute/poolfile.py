@@ -0,0 +1,220 @@
+'''
+poolfile.py - .py file to store gacha pools in a compact binary format
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+
+Layout, little endian:
+    header   magic, version, card count, string table size
+    rate     count x float64
+    sp_rate  count x float64
+    cards    count x (name offset, tag offset, rarity, flags)
+    strings  NUL terminated utf-8, each name / tag stored once
+'''
+
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+from . import storage
+
+
+'''
+Definitions
+'''
+
+EXT = '.pool'
+MAGIC = b'CGPL'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHxxII')
+RECORD = struct.Struct('<IIBBxx')
+RATE_SIZE = 8
+
+RARITIES = ('R', 'SR', 'SSR')
+LIM, PICKUP = 1, 2
+
+# Tag offset of a card without a tag
+NO_TAG = 0xFFFFFFFF
+
+
+class PoolFile(object):
+    '''
+    Memory-mapped pool: the rates are read straight from the mapping, card strings on access.
+    '''
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        magic, version, count, size = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise PoolFileError('not a pool file: {0}'.format(filepath))
+
+        offset = HEADER.size
+        self.count = count
+        self.rate = _rates(buffer, offset, count)
+        self.sp_rate = _rates(buffer, offset + count * RATE_SIZE, count)
+        self._records = offset + 2 * count * RATE_SIZE
+        self._strings = self._records + count * RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.card(i) for i in range(self.count))
+
+    def _string(self, offset):
+        '''
+        Read the string at offset of the string table.
+        :type offset: int
+        :rtype: str
+        '''
+        start = self._strings + offset
+        return self._mmap[start:self._mmap.find(b'\0', start)].decode('utf-8')
+
+    def card(self, index):
+        '''
+        Get the card at index as a dict like the ones in the json pools.
+        :type index: int
+        :rtype: dict
+        '''
+        name, tag, rarity, flags = RECORD.unpack_from(self._mmap, self._records + index * RECORD.size)
+        card = {'name': self._string(name), 'tag': None if tag == NO_TAG else self._string(tag),
+                'rarity': RARITIES[rarity], 'lim': bool(flags & LIM),
+                'rate': self.rate[index], 'sp_rate': self.sp_rate[index]}
+        if flags & PICKUP:
+            card['pickup'] = True
+        return card
+
+
+'''
+Exceptions
+'''
+
+class PoolFileError(Exception):
+    pass
+
+
+'''
+Private Functions
+'''
+
+def _rates(buffer, offset, count):
+    '''
+    Get a float64 view of the rates at offset, without copying when the byte order allows.
+    :type buffer: memoryview
+    :type offset: int
+    :type count: int
+    :rtype: memoryview or array
+    '''
+    view = buffer[offset:offset + count * RATE_SIZE]
+    if sys.byteorder == 'little':
+        return view.cast('d')
+    rates = array('d', view.tobytes())
+    rates.byteswap()
+    return rates
+
+
+def _validate(cards, filepath):
+    '''
+    Check the json pool is a non-empty list of card dicts that can be packed.
+    :type cards: any
+    :type filepath: str
+    :rtype: list
+    '''
+    if not isinstance(cards, list) or not cards:
+        raise PoolFileError('no cards in json pool: {0}'.format(filepath))
+    for card in cards:
+        if not isinstance(card, dict) or 'lim' not in card or not isinstance(card.get('name'), str) or \
+                not isinstance(card.get('tag'), (str, type(None))) or card.get('rarity') not in RARITIES or \
+                not all(isinstance(card.get(key), (int, float)) for key in ('rate', 'sp_rate')):
+            raise PoolFileError('invalid card in json pool: {0}'.format(filepath))
+    return cards
+
+
+'''
+Public Functions
+'''
+
+def dumps(cards):
+    '''
+    Pack the card dicts of a pool.
+    :type cards: list
+    :rtype: bytes
+    '''
+    strings, offsets = bytearray(), {}
+
+    def intern(string):
+        if string not in offsets:
+            offsets[string] = len(strings)
+            strings.extend(string.encode('utf-8') + b'\0')
+        return offsets[string]
+
+    records = bytearray()
+    for card in cards:
+        flags = (LIM if card['lim'] else 0) | (PICKUP if card.get('pickup') else 0)
+        tag = NO_TAG if card['tag'] is None else intern(card['tag'])
+        records.extend(RECORD.pack(intern(card['name']), tag, RARITIES.index(card['rarity']), flags))
+
+    return b''.join((HEADER.pack(MAGIC, VERSION, len(cards), len(strings)),
+                     struct.pack('<{0}d'.format(len(cards)), *(card['rate'] for card in cards)),
+                     struct.pack('<{0}d'.format(len(cards)), *(card['sp_rate'] for card in cards)),
+                     bytes(records), bytes(strings)))
+
+
+def write(filepath, cards):
+    '''
+    Write the card dicts of a pool.
+    :type filepath: str
+    :type cards: list
+    '''
+    storage.write(filepath, dumps(cards))
+
+
+def load(filepath):
+    '''
+    Map the pool file.
+    :type filepath: str
+    :rtype: PoolFile
+    '''
+    return PoolFile(filepath)
+
+
+def read_json(filepath):
+    '''
+    Read the card dicts of a json pool.
+    :type filepath: str
+    :rtype: list
+    :raises PoolFileError: the file is not json, null or has invalid cards
+    '''
+    try:
+        with open(filepath, 'r') as f:
+            cards = json.load(f)
+    except ValueError:
+        raise PoolFileError('not a json pool: {0}'.format(filepath))
+    return _validate(cards, filepath)
+
+
+def convert(src, dst=None):
+    '''
+    Convert a json pool into a pool file next to it.
+    The json pool is checked before anything is written.
+    :type src: str
+    :type dst: str or None
+    :rtype: str
+    :raises PoolFileError: see read_json
+    '''
+    dst = dst or os.path.splitext(src)[0] + EXT
+    write(dst, read_json(src))
+    return dst
+
+
+if __name__ == '__main__':
+    # python -m deresute.poolfile data/deresute/gacha/*.json
+    for src in sys.argv[1:]:
+        print(convert(src))
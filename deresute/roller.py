@@ -6,14 +6,21 @@ Github: https://github.com/maplemist
 Telegram: @maplemist
 '''
 
+from array import array
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 import collections
-import csv
 import json
 import logging
 import os
 import random
-import requests
+import threading
+import time
+
+from . import gacha
+from . import idols
+from . import network
+from . import poolfile
 
 
 '''
@@ -26,31 +33,100 @@ URL = {
     '346LAB': 'http://starlight.346lab.org/gacha/{0}'
 }
 
+# Parsed pools kept in memory, the least recently used is dropped first
+POOL_CACHE_SIZE = 32
+
+# Seconds to remember that a pool could not be gathered
+NEGATIVE_TTL = 10 * 60
+
+# Threads gathering new pools in the background
+PREFETCH_WORKERS = 4
+
+# Gachas listed per card by the card lookup, newest first
+LOOKUP_LIMIT = 5
+
+# Pool per gacha id with the mtime of its file and the samplers / results built from it,
+# and the time of the last failed gather per gacha id
+_pools = collections.OrderedDict()
+_missing = {}
+_pool_stats = {'hits': 0, 'misses': 0, 'negative': 0}
+_pool_lock = threading.Lock()
+
+# One lock per gacha id while its pool is gathered, and the ids queued for prefetch
+_gathering = {}
+_prefetching = set()
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+# Interned cards, the id of each (name, tag, rarity, lim), and the table loaded once to build them
+_catalog = {'cards': [], 'ids': {}, 'ssr2': None}
+_catalog_lock = threading.Lock()
+
+# Gacha ids per (name, tag, rarity, lim) across all pool files, and the keys per name
+_card_index = {'gachas': None, 'names': {}}
+_card_index_lock = threading.Lock()
+
+# A pool is the card ids with their rates, read straight from the mapped pool file
+pool_t = collections.namedtuple('pool_t', ('cards', 'rate', 'sp_rate'))
+
 
 class hashabledict(dict):
     def __hash__(self):
         return hash(tuple(sorted(self.items())))
 
 
-'''
-Private Functions
-'''
+class card_t(object):
+    '''
+    Card record interned in the catalog, identified by an integer id.
+    '''
+    __slots__ = ('id', 'name', 'tag', 'rarity', 'lim', 'ssr2')
+
+    def __init__(self, id, name, tag, rarity, lim, ssr2):
+        self.id, self.name, self.tag = id, name, tag
+        self.rarity, self.lim, self.ssr2 = rarity, lim, ssr2
 
-def _translator():
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class AliasSampler(object):
     '''
-    Translated Romaji names into Kanji names.
-    :rtype: function
+    Walker / Vose alias table, built once per pool and rate type, drawing an index in O(1).
     '''
-    dic = hashabledict()
-    filepath = os.path.join(os.getcwd(), 'data', 'deresute', 'names.csv')
-    with open(filepath, newline='\n') as f:
-        # ['Sagisawa Fumika', '鷺沢文香']
-        reader = csv.DictReader(f, delimiter=',')
-        for row in reader:
-            dic[row['Romaji']] = row['Name']
-    return lambda entity: dic.get(entity, entity)
+    __slots__ = ('prob', 'alias')
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.prob, self.alias = [1.0] * n, list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def sample(self, k):
+        '''
+        Draw k indices.
+        :type k: int
+        :rtype: list
+        '''
+        prob, alias, n = self.prob, self.alias, len(self.prob)
+        results = []
+        for _ in range(k):
+            u = random.random() * n
+            i = int(u)
+            results.append(i if u - i < prob[i] else alias[i])
+        return results
 
 
+'''
+Private Functions
+'''
+
 def _compute_special_rate(pool, pickupSR):
     '''
     Compute the special rate and put it into the pool.
@@ -79,10 +155,10 @@ def _gather_helper(id, db):
     pickup, pickupSR = True, 0
 
     # Translator
-    translate = _translator()
+    translate = idols.translate
 
     # Find the table
-    resp = requests.get(URL[db].format(id))
+    resp = network.get(URL[db].format(id))
     soup = BeautifulSoup(resp.text, 'html.parser')
     table = soup.find('div', {'class': 'contains_large_table'}).table.tbody.findAll('tr')
     for row in table:
@@ -143,20 +219,126 @@ def _gather_info(id):
     return pool
 
 
+def _get_filepath(id, ext=poolfile.EXT):
+    '''
+    Get the path of the pool file.
+    :type id: int
+    :type ext: str
+    :rtype: str
+    '''
+    return os.path.join(DIR, '{0}{1}'.format(id, ext))
+
+
 def _write_pool(id, pool):
     '''
-    Write the pool data into local json file.
+    Write the pool data into local pool file.
     :type id: int
     :type pool: dict
     '''
-    # Check directory existence
-    if not os.path.exists(DIR):
-        os.makedirs(DIR)
+    # Write pool data to pool file
+    poolfile.write(_get_filepath(id), pool)
+    _update_card_index(id, pool)
+
+
+def _index_cards(id, cards):
+    '''
+    Add the cards of the gacha to the card index. Needs _card_index_lock.
+    :type id: int
+    :type cards: iterable of dict
+    '''
+    for card in cards:
+        key = (idols.translate(card['name']), card['tag'], card['rarity'], card['lim'])
+        if key not in _card_index['gachas']:
+            _card_index['gachas'][key] = set()
+            _card_index['names'].setdefault(key[0], []).append(key)
+        _card_index['gachas'][key].add(id)
+
+
+def _get_card_index():
+    '''
+    Get the card index, building it from every pool file the first time.
+    :rtype: dict
+    '''
+    with _card_index_lock:
+        if _card_index['gachas'] is not None:
+            return _card_index
+
+        _card_index['gachas'], _card_index['names'] = {}, {}
+        filenames = os.listdir(DIR) if os.path.isdir(DIR) else []
+        for filename in filenames:
+            id, ext = os.path.splitext(filename)
+            if not id.isdigit():
+                continue
+            filepath = os.path.join(DIR, filename)
+
+            # Old json pools are indexed as they are, unless they were converted already
+            if ext == poolfile.EXT:
+                _index_cards(int(id), poolfile.load(filepath))
+            elif ext == '.json' and id + poolfile.EXT not in filenames:
+                try:
+                    _index_cards(int(id), poolfile.read_json(filepath))
+                except poolfile.PoolFileError as e:
+                    _remove_legacy(filepath, e)
+        return _card_index
+
+
+def _update_card_index(id, cards):
+    '''
+    Add a newly written pool to the card index, if it was built already.
+    :type id: int
+    :type cards: list
+    '''
+    with _card_index_lock:
+        if _card_index['gachas'] is not None:
+            _index_cards(id, cards)
+
+
+def _find_names(query):
+    '''
+    Get the indexed names of the idols matching the query.
+    :type query: str
+    :rtype: list
+    '''
+    names = _get_card_index()['names']
+    return [idol.name for idol in idols.search(query) if idol.name in names]
+
+
+def _get_ssr2():
+    '''
+    Get the SSR2 cards, name to tag.
+    :rtype: dict
+    '''
+    filepath = os.path.join(os.getcwd(), 'data', 'deresute', 'ssr2.json')
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def _intern(card):
+    '''
+    Get the catalog id of the card, adding it on first sight.
+    :type card: dict
+    :rtype: int
+    '''
+    name = idols.translate(card['name'])
+    with _catalog_lock:
+        if _catalog['ssr2'] is None:
+            _catalog['ssr2'] = _get_ssr2()
+
+        key = (name, card['tag'], card['rarity'], card['lim'])
+        if key not in _catalog['ids']:
+            ssr2 = name in _catalog['ssr2'] and card['tag'] == '[{0}]'.format(_catalog['ssr2'][name])
+            _catalog['ids'][key] = len(_catalog['cards'])
+            _catalog['cards'].append(card_t(len(_catalog['cards']), name, card['tag'], card['rarity'], card['lim'], ssr2))
+        return _catalog['ids'][key]
+
 
-    # Write pool data to json file
-    filepath = os.path.join(DIR, '{0}.json'.format(id))
-    with open(filepath, 'w') as f:
-        json.dump(pool, f, indent=2, ensure_ascii=False)
+def _compile_pool(cards):
+    '''
+    Turn the cards of a pool file into catalog ids, keeping its mapped rate arrays.
+    :type cards: poolfile.PoolFile
+    :rtype: pool_t
+    '''
+    return pool_t(array('I', (_intern(card) for card in cards)), cards.rate, cards.sp_rate)
 
 
 def _create_pool(id):
@@ -168,35 +350,135 @@ def _create_pool(id):
     # Gather info
     pool = _gather_info(id)
 
-    # Write json
-    _write_pool(id, pool)
+    # Write pool file
+    if pool:
+        _write_pool(id, pool)
     return pool
 
 
+def _get_mtime(filepath):
+    '''
+    Get the mtime of the file.
+    :type filepath: str
+    :rtype: float or None
+    '''
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
+
+
+def _remove_legacy(filepath, error):
+    '''
+    Remove a json pool that cannot be read, so it is gathered again.
+    :type filepath: str
+    :type error: poolfile.PoolFileError
+    '''
+    logging.warning('removing json pool: {0}'.format(error))
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def _load_cards(id, filepath):
+    '''
+    Map the pool file, converting an old json pool or gathering the pool first if there is none.
+    Only one thread gathers a pool, the others wait and read its file.
+    :type id: int
+    :type filepath: str
+    :rtype: (poolfile.PoolFile, float) or (None, None)
+    '''
+    with _pool_lock:
+        lock = _gathering.setdefault(id, threading.Lock())
+
+    with lock:
+        mtime = _get_mtime(filepath)
+        if mtime is None:
+            legacy = _get_filepath(id, '.json')
+            if os.path.isfile(legacy):
+                try:
+                    poolfile.convert(legacy, filepath)
+                except poolfile.PoolFileError as e:
+                    # A null or broken json pool counts as missing
+                    _remove_legacy(legacy, e)
+            if _get_mtime(filepath) is None:
+                _create_pool(id)
+            mtime = _get_mtime(filepath)
+        if mtime is None:
+            return None, None
+        return poolfile.load(filepath), mtime
+
+
+def _prefetch(id):
+    '''
+    Gather and load the pool in the background.
+    :type id: int
+    '''
+    try:
+        _get_pool(id)
+    except Exception as e:
+        logging.warning('pool {0} prefetch failed: {1}'.format(id, e))
+    finally:
+        with _pool_lock:
+            _prefetching.discard(id)
+
+
 def _get_pool(id):
     '''
-    Get the pool information.
+    Get the pool information, from memory unless its file changed.
     :type id: int
-    :rtype: dict
+    :rtype: pool_t or None
+    '''
+    filepath = _get_filepath(id)
+    mtime = _get_mtime(filepath)
+    with _pool_lock:
+        if mtime is not None and id in _pools and _pools[id][0] == mtime:
+            _pools.move_to_end(id)
+            _pool_stats['hits'] += 1
+            return _pools[id][1]
+        if mtime is None and time.time() - _missing.get(id, 0) < NEGATIVE_TTL:
+            _pool_stats['negative'] += 1
+            return None
+        _pool_stats['misses'] += 1
+
+    cards, mtime = _load_cards(id, filepath)
+    if not cards:
+        with _pool_lock:
+            _missing[id] = time.time()
+        return None
+
+    pool = _compile_pool(cards)
+    with _pool_lock:
+        _missing.pop(id, None)
+        _pools[id] = (mtime, pool, {})
+        _pools.move_to_end(id)
+        while len(_pools) > POOL_CACHE_SIZE:
+            _pools.popitem(last=False)
+    return pool
+
+
+def _get_card(id):
+    '''
+    Get the card record of the catalog id.
+    :type id: int
+    :rtype: card_t
     '''
-    # Check json existence
-    filepath = os.path.join(DIR, '{0}.json'.format(id))
-    if os.path.isfile(filepath):
-        with open(filepath, 'r') as f:
-            return json.load(f, object_hook=hashabledict)
-    return _create_pool(id)
+    return _catalog['cards'][id]
 
 
-def _is_ssr2(card):
+def _get_sampler(id, pool, rate):
     '''
-    Check if card is SSR2.
-    :type card: dict
-    :rtype: bool
+    Get the sampler of the pool, built once per loaded pool.
+    :type id: int
+    :type pool: pool_t
+    :type rate: str
+    :rtype: AliasSampler
     '''
-    filepath = os.path.join(os.getcwd(), 'data', 'deresute', 'ssr2.json')
-    with open(filepath, 'r') as f:
-        d = json.load(f)
-        return card['name'] in d and card['tag'] == '[{0}]'.format(d[card['name']])
+    memo = get_memo(id, pool)
+    if ('sampler', rate) not in memo:
+        memo[('sampler', rate)] = AliasSampler(getattr(pool, rate))
+    return memo[('sampler', rate)]
 
 
 def _roll(id, amount, rate='rate'):
@@ -204,54 +486,70 @@ def _roll(id, amount, rate='rate'):
     Do 'amount' of rolls on the gacha pool with id.
     :type: id: int
     :type amount: int
-    :rtype: lst
+    :rtype: list of card_t, empty if there is no pool
     '''
     # Get pool
     pool = _get_pool(id)
+    if not pool:
+        return []
+
+    # Draw with the precompiled sampler of the rate
+    return [_get_card(pool.cards[i]) for i in _get_sampler(id, pool, rate).sample(amount)]
 
-    # Use normal rate
-    rates = [card[rate] for card in pool]
-    return random.choices(pool, rates, k=amount)
+
+def _roll_counts(samplers):
+    '''
+    Draw card indices in bulk, and count them per card.
+    :type samplers: list of (AliasSampler, int)
+    :rtype: collections.Counter
+    '''
+    counts = collections.Counter()
+    for sampler, amount in samplers:
+        counts.update(sampler.sample(amount))
+    return counts
 
 
-def _get_results(gacha, rolls):
+def _get_results(gacha, pool, counts):
     '''
-    Create output string based on the rolls.
+    Create output string based on the roll counts per card index.
+    Only the cards that were drawn are looked at.
     :type gacha: dict
-    :type rolls: list
+    :type pool: pool_t
+    :type counts: collections.Counter
     :rtype: str
     '''
     # Build dict
-    dic = collections.defaultdict(collections.Counter)
-    for card in rolls:
-        key = (card['rarity'], card['lim'])
-        dic[key][card] += 1
+    dic = collections.defaultdict(list)
+    for i in sorted(counts):
+        card = _get_card(pool.cards[i])
+        dic[(card.rarity, card.lim)].append((card, counts[i]))
 
     results = ''
     # Limited SSR
-    lim_ssr = sum(dic[('SSR', True)].values())
+    lim_ssr = sum(count for _, count in dic[('SSR', True)])
     if lim_ssr > 0:
         results += '\n限定SSR: {0}\n'.format(lim_ssr) + \
                    '\n'.join('{0[tag]} {0[name]} {1}'.format(card, 'x{0}'.format(count) if count > 1 else '')
-                   for card, count in dic[('SSR', True)].items())
+                   for card, count in dic[('SSR', True)])
 
     # Regular SSR
-    reg_ssr = sum(dic[('SSR', False)].values())
+    reg_ssr = sum(count for _, count in dic[('SSR', False)])
     if reg_ssr > 0:
         results += '\nSSR: {0}\n'.format(reg_ssr) + \
-                   ', '.join('{0[name]}{1}{2}'.format(card, '2' if _is_ssr2(card) else '',
+                   ', '.join('{0[name]}{1}{2}'.format(card, '2' if card.ssr2 else '',
                    ' x{0}'.format(count) if count > 1 else '')
-                   for card, count in dic[('SSR', False)].items())
+                   for card, count in dic[('SSR', False)])
 
     # Limited SR
-    lim_sr = sum(dic[('SR', True)].values())
+    lim_sr = sum(count for _, count in dic[('SR', True)])
     if lim_sr > 0:
         results += '\n限定SR: {0}\n'.format(lim_sr) + \
                    '\n'.join('{0[tag]} {0[name]} {1}'.format(card, 'x{0}'.format(count) if count > 1 else '')
-                   for card, count in dic[('SR', True)].items())
+                   for card, count in dic[('SR', True)])
 
     # Regular SR & R
-    footer = '\nSR: {0} \t R: {1}'.format(sum(dic[('SR', False)].values()), sum(dic[('R', False)].values()))
+    footer = '\nSR: {0} \t R: {1}'.format(sum(count for _, count in dic[('SR', False)]),
+                                           sum(count for _, count in dic[('R', False)]))
     return gacha['name'] + results + footer
 
 
@@ -259,13 +557,16 @@ def _output1(gacha):
     '''
     Roll the gacha pool, and get the result message from rolling the gacha pool id once.
     :type gacha: dict
-    :rtype: dict
+    :rtype: dict, empty if there is no pool
     '''
-    card = _roll(gacha['id'], 1)[0]
+    cards = _roll(gacha['id'], 1)
+    if not cards:
+        return {}
+    card = cards[0]
 
     # Get parameters
-    lim = '限' if card['lim'] else ''
-    tag = card['tag'] if card['tag'] else ''
+    lim = '限' if card.lim else ''
+    tag = card.tag if card.tag else ''
     return {'results': '{0[name]}\n{2}{1[rarity]}: {3} {1[name]}'.format(gacha, card, lim, tag), 'card': card}
 
 
@@ -273,17 +574,114 @@ def _output1(gacha):
 Public Functions
 '''
 
+def get_pool(id):
+    '''
+    Get the pool of the gacha.
+    :type id: int
+    :rtype: pool_t or None
+    '''
+    return _get_pool(id)
+
+
+def get_card(id):
+    '''
+    Get the card record of the catalog id.
+    :type id: int
+    :rtype: card_t
+    '''
+    return _get_card(id)
+
+
 def output(gacha, total):
     '''
     Roll the gacha pool, and get the result message from rolling the gacha pool id with k amount.
     :type gacha: dict
     :type total: int
-    :rtype: dict
+    :rtype: dict, empty if there is no pool
     '''
     if total == 1:
         return _output1(gacha)
 
+    pool = _get_pool(gacha['id'])
+    if not pool:
+        return {}
+
+    # Every 10th roll uses the special rate
     k = total // 10
-    rolls = _roll(gacha['id'], total - k)
-    tenth = _roll(gacha['id'], k, rate='sp_rate')
-    return {'results': _get_results(gacha, rolls + tenth)}
+    counts = _roll_counts([(_get_sampler(gacha['id'], pool, 'rate'), total - k),
+                           (_get_sampler(gacha['id'], pool, 'sp_rate'), k)])
+    return {'results': _get_results(gacha, pool, counts)}
+
+
+def get_memo(id, pool):
+    '''
+    Get the dict of values built from the pool, dropped together with the pool when it is evicted or reloaded.
+    A pool no longer cached gets a throwaway dict.
+    :type id: int
+    :type pool: pool_t
+    :rtype: dict
+    '''
+    with _pool_lock:
+        if id in _pools and _pools[id][1] is pool:
+            return _pools[id][2]
+    return {}
+
+
+def prefetch_pools(ids):
+    '''
+    Gather the pools of the gacha ids on the prefetch threads, skipping the ones already queued.
+    :type ids: list of int
+    '''
+    with _pool_lock:
+        ids = [id for id in ids if id not in _prefetching]
+        _prefetching.update(ids)
+    for id in ids:
+        logging.info('pool {0} prefetch'.format(id))
+        _executor.submit(_prefetch, id)
+
+
+def find_card(query, tag=None):
+    '''
+    Get the gachas that had the cards of the idol, per (name, tag, rarity, lim).
+    :type query: str, Romaji, Kanji or kana, whole or partial
+    :type tag: str or None
+    :rtype: dict
+    '''
+    index = _get_card_index()
+    return {key: sorted(index['gachas'][key]) for name in _find_names(query)
+            for key in index['names'][name] if tag is None or key[1] == tag}
+
+
+def find_output(query, current=()):
+    '''
+    Get the message listing the gachas that had the SSR and SR cards of the idol.
+    :type query: str, name optionally followed by a [tag]
+    :type current: list of int, ids of the gachas live now
+    :rtype: str or None
+    '''
+    query, _, tag = query.partition('[')
+    cards = find_card(query.strip(), '[' + tag.strip() if tag else None)
+    keys = sorted((key for key in cards if key[2] != 'R'),
+                  key=lambda key: (key[0], ('SSR', 'SR').index(key[2]), not key[3], key[1] or ''))
+    if not keys:
+        return None
+
+    results = []
+    for name, tag, rarity, lim in keys:
+        ids = cards[(name, tag, rarity, lim)][::-1]
+        lines = ['{0}{1}: {2} {3}'.format('限定' if lim else '', rarity, tag or '', name)]
+        lines += ['  {0}{1}'.format(gacha.get_name(id) or id, ' ★' if id in current else '')
+                  for id in ids[:LOOKUP_LIMIT]]
+        if len(ids) > LOOKUP_LIMIT:
+            lines.append('  他 {0} 件'.format(len(ids) - LOOKUP_LIMIT))
+        results.append('\n'.join(lines))
+    return '\n'.join(results)
+
+
+def stats():
+    '''
+    Get pool cache counters.
+    :rtype: dict
+    '''
+    with _pool_lock:
+        return dict(_pool_stats, size=len(_pools), missing=len(_missing), prefetching=len(_prefetching))
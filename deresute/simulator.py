@@ -0,0 +1,165 @@
+'''
+simulator.py - .py file to do Monte Carlo gacha simulations
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import random
+import threading
+
+from . import idols, roller
+
+
+'''
+Definitions
+'''
+
+# Simulated sessions per query, split into batches over the process pool
+SESSIONS = 200000
+BATCHES = 8
+WORKERS = 4
+
+# Pulls to spark a card, and jewels per pull
+SPARK = 300
+JEWELS = 250
+
+sim_t = collections.namedtuple('sim_t', ('target', 'pulls', 'probability', 'jewels', 'sessions'))
+
+_executor = {'pool': None}
+_lock = threading.Lock()
+
+
+'''
+Private Functions
+'''
+
+def _get_executor():
+    '''
+    Get the process pool, starting it on first use.
+    :rtype: ProcessPoolExecutor
+    '''
+    with _lock:
+        if _executor['pool'] is None:
+            _executor['pool'] = ProcessPoolExecutor(max_workers=WORKERS)
+        return _executor['pool']
+
+
+def _simulate(p, q, pulls, sessions, seed):
+    '''
+    Simulate sessions of 10-pulls, and count the pull at which the target first shows up.
+    Every 10th pull uses the special rate. A whole 10-pull is decided with one draw,
+    and only a 10-pull with a hit is drawn pull by pull.
+    :type p: float, target probability of a normal pull
+    :type q: float, target probability of a 10th pull
+    :type pulls: int
+    :type sessions: int
+    :type seed: int
+    :rtype: list, index 0 counts sessions without the target
+    '''
+    rng = random.Random(seed)
+    miss = (1 - p) ** 9 * (1 - q)
+    blocks = (pulls + 9) // 10
+    firsts = [0] * (blocks * 10 + 1)
+    for _ in range(sessions):
+        for block in range(blocks):
+            if rng.random() < miss:
+                continue
+
+            # Find the pull of the hit, given that the 10-pull has one
+            left = 1 - miss
+            for i in range(10):
+                r = p if i < 9 else q
+                if rng.random() * left < r:
+                    firsts[block * 10 + i + 1] += 1
+                    break
+                left = (left - r) / (1 - r)
+            break
+        else:
+            firsts[0] += 1
+    return firsts
+
+
+def _get_target(pool, query):
+    '''
+    Get the target cards of the pool: cards of the idols matching query, or the limited SSRs.
+    :type pool: roller.pool_t
+    :type query: str or None, Romaji, Kanji or kana, whole or partial
+    :rtype: list of int, indices in the pool
+    '''
+    cards = [roller.get_card(id) for id in pool.cards]
+    if query:
+        # Idols found by the search, then names containing the query as written
+        names = {idol.name for idol in idols.search(query)}
+        for match in (lambda card: card.name in names, lambda card: query in card.name):
+            target = [i for i, card in enumerate(cards) if match(card) and card.rarity == 'SSR'] or \
+                     [i for i, card in enumerate(cards) if match(card)]
+            if target:
+                return target
+        return []
+    return [i for i, card in enumerate(cards) if card.lim and card.rarity == 'SSR'] or \
+           [i for i, card in enumerate(cards) if card.rarity == 'SSR']
+
+
+'''
+Public Functions
+'''
+
+def simulate(id, pulls, query=None):
+    '''
+    Get the chance to get the target within pulls, and the expected jewels to get it (spark at SPARK).
+    Results are memoized with the cached pool, per (query, pulls).
+    :type id: int
+    :type pulls: int
+    :type query: str or None
+    :rtype: sim_t or None
+    '''
+    pool = roller.get_pool(id)
+    if not pool:
+        return None
+    target = _get_target(pool, query)
+    if not target:
+        return None
+
+    # Results live with the cached pool, so they go when it is evicted or reloaded
+    memo = roller.get_memo(id, pool)
+    key = ('simulation', tuple(target), pulls)
+    if key in memo:
+        return memo[key]
+
+    # Spread the batches over the process pool
+    p = sum(pool.rate[i] for i in target) / sum(pool.rate)
+    q = sum(pool.sp_rate[i] for i in target) / sum(pool.sp_rate)
+    horizon = max(pulls, SPARK)
+    batches = [_get_executor().submit(_simulate, p, q, horizon, SESSIONS // BATCHES, random.getrandbits(32))
+               for _ in range(BATCHES)]
+    firsts = [sum(counts) for counts in zip(*(batch.result() for batch in batches))]
+    sessions = sum(firsts)
+
+    # Sessions that reach the spark get the card at SPARK pulls
+    probability = sum(firsts[1:pulls + 1]) / sessions
+    jewels = sum(min(n, SPARK) * count for n, count in enumerate(firsts) if n) + SPARK * firsts[0]
+    jewels = JEWELS * jewels / sessions
+
+    names = sorted(set(roller.get_card(pool.cards[i]).name for i in target))
+    result = sim_t(', '.join(names), pulls, probability, jewels, sessions)
+    memo[key] = result
+    return result
+
+
+def output(gacha, pulls, query=None):
+    '''
+    Get the simulation message of the gacha pool.
+    :type gacha: dict
+    :type pulls: int
+    :type query: str or None
+    :rtype: str or None
+    '''
+    result = simulate(gacha['id'], pulls, query)
+    if not result:
+        return None
+    return '{0[name]}\n{1.target}\n{1.pulls}連で引ける確率: {1.probability:.1%}\n'.format(gacha, result) + \
+           '期待ジュエル: {0:,.0f} (天井 {1} 連)\n({2:,} 回シミュレーション)'.format(result.jewels, SPARK, result.sessions)
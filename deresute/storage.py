@@ -0,0 +1,47 @@
+'''
+storage.py - .py file to write local data files
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import json
+import os
+import tempfile
+
+
+'''
+Public Functions
+'''
+
+def write(filepath, content):
+    '''
+    Write content to the file through a temporary file in the same directory,
+    so a reader or a crash never sees half a file.
+    :type filepath: str
+    :type content: str or bytes
+    '''
+    # Check directory existence
+    dir = os.path.dirname(filepath)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=dir or None, prefix=os.path.basename(filepath) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filepath)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_json(filepath, data, **kwargs):
+    '''
+    Write data to the json file, see write.
+    :type filepath: str
+    :type data: dict or list
+    '''
+    write(filepath, json.dumps(data, **kwargs))
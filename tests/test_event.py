@@ -0,0 +1,55 @@
+'''
+test_event.py - golden file tests of the aidoru border page parser
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import json
+import os
+
+import pytest
+
+from deresute import event
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def _read(filename):
+    with open(os.path.join(FIXTURES, filename), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _chunks(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, 4096, event.CHUNK_SIZE])
+def test_extract_datum_matches_golden(size):
+    '''The datum array is found whatever the chunk boundaries are, and parses to the saved border data.'''
+    page = _read('aidoru_border.html')
+    golden = json.loads(_read('aidoru_border.json'))
+
+    text = event._extract_datum(_chunks(page, size))
+    assert text.startswith('[') and text.endswith(']')
+    assert event._parse_datum(text) == golden
+
+
+def test_extract_datum_without_chart():
+    '''A page without the chart gives None instead of raising.'''
+    page = _read('aidoru_border.html').replace(event.CHART_MARKER, '')
+    assert event._extract_datum(_chunks(page, 1024)) is None
+
+
+def test_border_series_from_golden():
+    '''The parsed border data fills one point per collection for every tier.'''
+    golden = json.loads(_read('aidoru_border.json'))
+    series = event.border.BorderSeries(0)
+    assert series.extend(golden) == len(golden[0]['values'])
+    assert list(series.tiers) == [data['key'].split(' ')[0] for data in golden]
+    assert series.value('501位') == golden[0]['values'][-1][1]
+
+    # Extending with the same data again adds nothing
+    assert series.extend(golden) == 0
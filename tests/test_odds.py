@@ -0,0 +1,43 @@
+'''
+test_odds.py - tests of the exact odds against the rolls of the alias sampler
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import random
+
+import pytest
+
+from deresute import odds, roller
+
+
+# Rates in percent like the pools, the first two cards being the target
+RATE = [1.5, 1.5, 9.0, 88.0]
+SP_RATE = [3.0, 3.0, 97.0, 0.0]
+TARGET = {0, 1}
+
+TRIALS = 20000
+TOLERANCE = 0.02
+
+
+@pytest.mark.parametrize('total', [10, 30])
+def test_distribution_matches_sampler(total):
+    '''The exact distribution of hits is within TOLERANCE of the frequencies of seeded sampler rolls.'''
+    random.seed(20)
+    normal, special = roller.AliasSampler(RATE), roller.AliasSampler(SP_RATE)
+
+    counts = [0] * (total + 1)
+    for _ in range(TRIALS):
+        # Every 10th roll uses the special rate
+        k = total // 10
+        draws = normal.sample(total - k) + special.sample(k)
+        counts[sum(1 for i in draws if i in TARGET)] += 1
+
+    p = sum(RATE[i] for i in TARGET) / sum(RATE)
+    q = sum(SP_RATE[i] for i in TARGET) / sum(SP_RATE)
+    distribution = odds._distribution(total, p, q)
+    assert sum(distribution) == pytest.approx(1.0)
+    for expected, count in zip(distribution, counts):
+        assert abs(expected - count / TRIALS) < TOLERANCE
@@ -0,0 +1,53 @@
+'''
+test_poolfile.py - tests of the pool file conversion of old json pools
+
+Written by Alex Wong
+Github: https://github.com/maplemist
+Telegram: @maplemist
+'''
+
+import json
+
+import pytest
+
+from deresute import poolfile, roller
+
+
+CARDS = [
+    {'name': '鷺沢文香', 'tag': '[ブライトメモリーズ]', 'rarity': 'SSR', 'lim': True, 'rate': 1.5, 'sp_rate': 1.5, 'pickup': True},
+    {'name': '橘ありす', 'tag': None, 'rarity': 'R', 'lim': False, 'rate': 98.5, 'sp_rate': 0.0},
+]
+
+INVALID = ['null', '[]', '{"name": "x"}', '[{"name": "x"}]', '[null]', 'not json',
+           json.dumps([dict(CARDS[1], rarity='UR')]), json.dumps([{k: v for k, v in CARDS[1].items() if k != 'lim'}])]
+
+
+def test_convert_round_trip(tmp_path):
+    '''A converted pool file reads back as the json cards.'''
+    src = tmp_path / '1.json'
+    src.write_text(json.dumps(CARDS))
+    pool = poolfile.load(poolfile.convert(str(src)))
+    assert list(pool) == CARDS
+
+
+@pytest.mark.parametrize('content', INVALID)
+def test_convert_invalid(tmp_path, content):
+    '''A null or invalid json pool raises PoolFileError and leaves nothing behind.'''
+    src = tmp_path / '1.json'
+    src.write_text(content)
+    with pytest.raises(poolfile.PoolFileError):
+        poolfile.convert(str(src))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['1.json']
+
+
+@pytest.mark.parametrize('content', INVALID)
+def test_card_index_removes_invalid(tmp_path, monkeypatch, content):
+    '''The card index skips and removes null or invalid json pools, and indexes the others.'''
+    (tmp_path / '1.json').write_text(json.dumps(CARDS))
+    (tmp_path / '2.json').write_text(content)
+    monkeypatch.setattr(roller, 'DIR', str(tmp_path))
+    monkeypatch.setattr(roller, '_card_index', {'gachas': None, 'names': {}})
+
+    gachas = roller._get_card_index()['gachas']
+    assert sorted(id for ids in gachas.values() for id in ids) == [1, 1]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['1.json']